@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Henter DOFbasens CSV for en valgt dato (DD-MM-YYYY), gemmer den,
+Henter DOFbasens CSV for en valgt dato (DD-MM-YYYY) direkte i hukommelsen,
 detekterer første observation pr. (Artnavn × Loknr) pr. dag (DK-tid)
 og leverer resultater pr. klient-profil via stdout/fil/webpush.
 
@@ -20,8 +20,10 @@ import sys
 import re
 import mimetypes
 import unicodedata
+import difflib
 import warnings
 
+import numpy as np
 import pandas as pd
 import yaml
 import argparse
@@ -33,14 +35,27 @@ import json
 from pathlib import Path
 import os           # NYT
 import tempfile     # NYT
+import shutil
 import time         # NYT
-from typing import Dict, List, Tuple, Optional
+import hashlib
+import threading
+import io
+import gzip
+import codecs
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Optional, Set
+from types import MappingProxyType
 
 
 import requests
 import yaml
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+try:
+    import brotli  # valgfri: .br-udgaver af JSON-artefakter (ellers kun .gz)
+except ImportError:
+    brotli = None
+
 # ───────────────────────────────── Konstanter og stier ─────────────────────────────────
 warnings.simplefilter(action="ignore", category=FutureWarning)
 DK_TZ = ZoneInfo("Europe/Copenhagen")
@@ -60,11 +75,35 @@ FEED_FILE = Path("web") / "feed.jsonl"
 META_FILE = Path("web") / "meta.json"
 LATEST_PUSH_FILE = Path("web") / "latest-push.json"
 STATE_FILE = STATE_DIR / "dof_state.json"
+STATE_LOG = STATE_DIR / "dof_state.log"
 SU_LIST = DATA_DIR / "SU-arter.csv"
 SUB_LIST = DATA_DIR / "SUB-arter.csv"
 BATCH_DIR = Path("web") / "batches"
 OBS_BASE = Path("web") / "obs"
 REQUIRED_COLS = ["Artnavn", "Loknr", "Loknavn", "Antal", "Dato", "Obsid"]
+# Kolonneskema for de DOFbasen-kolonner pipelinen læser (øvrige kolonner indlæses ikke).
+# Gentagne felter indlæses som 'category', resten som str.
+CSV_SCHEMA: Dict[str, str] = {
+    # påkrævede
+    "Artnavn": "category", "Loknr": "category", "Loknavn": "str", "Antal": "str", "Dato": "str", "Obsid": "str",
+    # tider
+    "Dato-tid": "str", "DatoTid": "str", "Obstidfra": "str", "Obstidtil": "str", "Obsidtil": "str",
+    "Turtidfra": "str", "Turtidtil": "str",
+    # koordinater
+    "obs_laengdegrad": "str", "obs_breddegrad": "str", "lok_laengdegrad": "str", "lok_breddegrad": "str",
+    "Coords": "str", "Koordinater": "str",
+    # region/lokalitet
+    "DOF_afdeling": "category", "Region": "str", "region": "str", "Lokalitet": "str",
+    # adfærd
+    "Adfbeskrivelse": "category", "Adfærd": "str", "Adfaerd": "str", "Adf": "str",
+    # observatør
+    "Fornavn": "str", "Efternavn": "str", "ObsNavn": "str", "Observatør": "str", "Observator": "str",
+    # noter
+    "Turnoter": "str", "TurNoter": "str", "Fuglnoter": "str", "Fuglenoter": "str",
+    # alternative obsid-kolonner
+    "ObsID": "str", "ObsId": "str", "obsid": "str", "ID": "str", "id": "str",
+}
+USED_COLS = set(CSV_SCHEMA)
 
 mimetypes.add_type("application/manifest+json", ".webmanifest")
 
@@ -89,6 +128,199 @@ def _atomic_write_text(path: Path, text: str, encoding: str = "utf-8"):
         except Exception: pass
         raise
 
+def _atomic_write_bytes(path: Path, data: bytes):
+    path = Path(path)
+    _ensure_dir(path.parent)
+    fd, tmp = tempfile.mkstemp(prefix=path.name, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try: os.unlink(tmp)
+        except Exception: pass
+        raise
+
+# Sidst publicerede indholds-digest pr. view (sha256 af de serialiserede bytes)
+_WRITTEN_DIGESTS: Dict[str, str] = {}
+
+def _json_bytes(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _bytes_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def _write_json_artifact(path: Path, obj, data: Optional[bytes] = None) -> str:
+    """
+    Skriv JSON som serveren leverer direkte: minificeret <fil>, forkomprimerede
+    <fil>.gz/<fil>.br og <fil>.etag (sha256 af JSON-bytes). .etag skrives sidst,
+    så serveren ikke annoncerer en ETag før indholdet ligger klar. Returnerer ETag.
+    """
+    path = Path(path)
+    data = _json_bytes(obj) if data is None else data
+    etag = _bytes_digest(data)
+    _atomic_write_bytes(path.with_name(path.name + ".gz"), gzip.compress(data, 9, mtime=0))
+    br_path = path.with_name(path.name + ".br")
+    if brotli is not None:
+        _atomic_write_bytes(br_path, brotli.compress(data, quality=9))
+    elif br_path.exists():
+        br_path.unlink()  # forældet .br må ikke leveres
+    _atomic_write_bytes(path, data)
+    _atomic_write_text(path.with_name(path.name + ".etag"), etag)
+    return etag
+
+# ─── Generationer (atomisk publicering af dagens views) ───
+# Views publiceres som nummererede generationer: web/obs/<dag>/gen/<N>/ rummer kun de
+# filer, der blev ændret i den poll, samt manifest.json med {sti: generation} for ALLE
+# dagens views og log_offset (hvor langt i events.log views er bygget). Filerne i en
+# generation er uforanderlige; web/obs/<dag>/current.json ({"gen": N}) er den eneste fil,
+# der erstattes (os.replace), så læsere altid ser én konsistent generation.
+# Generation 0 = ældre layout direkte under web/obs/<dag>/ (migreres ved første commit).
+OBS_GEN_KEEP = 3  # tidligere generationer der bevares for læsere med en ældre pointer
+
+_GEN_MANIFESTS: Dict[str, dict] = {}  # str(day_dir) -> {"gen", "files", "log_offset"}
+_GEN_PENDING: Dict[str, dict] = {}    # str(day_dir) -> generation under opbygning (+ "digests")
+
+def _gen_dir(day_dir: Path, gen: int) -> Path:
+    return Path(day_dir) / "gen" / str(gen)
+
+def _current_manifest(day_dir: Path, refresh: bool = False) -> dict:
+    key = str(day_dir)
+    m = _GEN_MANIFESTS.get(key)
+    if m is not None and not refresh:
+        return m
+    try:
+        gen = int(json.loads((Path(day_dir) / "current.json").read_text(encoding="utf-8"))["gen"])
+    except (OSError, ValueError, KeyError, TypeError):
+        gen = 0
+    if m is None or m["gen"] != gen:
+        m = {"gen": 0, "files": {}, "log_offset": 0}
+        if gen:
+            try:
+                loaded = json.loads((_gen_dir(day_dir, gen) / "manifest.json").read_text(encoding="utf-8"))
+                m = {"gen": gen, "files": dict(loaded.get("files") or {}),
+                     "log_offset": int(loaded.get("log_offset") or 0)}
+            except (OSError, ValueError, TypeError) as e:
+                print(f"[Advarsel] Manifest for generation {gen} i {day_dir} ulæseligt: {e}", file=sys.stderr)
+        _GEN_MANIFESTS[key] = m
+    return m
+
+def _view_path(day_dir: Path, rel: str) -> Optional[Path]:
+    """Sti til den aktuelle udgave af et view (inkl. filer staget i denne poll); None hvis det ikke findes."""
+    m = _GEN_PENDING.get(str(day_dir)) or _current_manifest(day_dir)
+    gen = m["files"].get(rel)
+    if gen is not None:
+        return _gen_dir(day_dir, gen) / rel
+    if m["gen"] == 0 or _current_manifest(day_dir)["gen"] == 0:
+        p = Path(day_dir) / rel
+        return p if p.exists() else None
+    return None
+
+def _stage_path(day_dir: Path, rel: str) -> Path:
+    """Sti i den generation, der er under opbygning (oprettes ved første skrivning i en poll)."""
+    key = str(day_dir)
+    p = _GEN_PENDING.get(key)
+    if p is None:
+        cur = _current_manifest(day_dir, refresh=True)
+        p = _GEN_PENDING[key] = {"gen": cur["gen"] + 1, "files": dict(cur["files"]),
+                                 "log_offset": cur["log_offset"], "digests": {}}
+        shutil.rmtree(_gen_dir(day_dir, p["gen"]), ignore_errors=True)  # rest fra afbrudt poll
+    p["files"][rel] = p["gen"]
+    return _gen_dir(day_dir, p["gen"]) / rel
+
+def _publish_json(day_dir: Path, rel: str, obj, artifact: bool = True) -> bool:
+    """
+    Stage et view i dagens næste generation – kun hvis indholdet er ændret. Digest af de
+    serialiserede bytes sammenlignes med det sidst publicerede (i hukommelsen; ved kold
+    start fra <fil>.etag) – selve filen læses ikke. artifact=False skriver kun JSON-filen
+    (ingen .gz/.br/.etag). Returnerer True hvis filen blev skrevet.
+    """
+    data = _json_bytes(obj)
+    digest = _bytes_digest(data)
+    key = str(Path(day_dir) / rel)
+    cur = _view_path(day_dir, rel)
+    pending = _GEN_PENDING.get(str(day_dir))
+    prev = (pending or {}).get("digests", {}).get(key) or _WRITTEN_DIGESTS.get(key)
+    if prev is None and artifact and cur is not None:
+        try:
+            prev = cur.with_name(cur.name + ".etag").read_text(encoding="utf-8").strip()
+        except OSError:
+            prev = None
+    if cur is not None and prev == digest:
+        return False
+    target = _stage_path(day_dir, rel)
+    if artifact:
+        _write_json_artifact(target, obj, data=data)
+    else:
+        _atomic_write_bytes(target, data)
+    _GEN_PENDING[str(day_dir)]["digests"][key] = digest
+    return True
+
+def _publish_commit(day_dir: Path, log_offset: Optional[int] = None) -> Optional[int]:
+    """
+    Skriv manifest for den stagede generation og flip current.json til den.
+    Returnerer det nye generationsnummer (None hvis intet er ændret).
+    """
+    key = str(day_dir)
+    cur = _current_manifest(day_dir)
+    p = _GEN_PENDING.pop(key, None)
+    if p is None:
+        if log_offset is None or log_offset == cur["log_offset"]:
+            return None
+        p = {"gen": cur["gen"] + 1, "files": dict(cur["files"]), "digests": {}}  # kun log_offset er nyt
+    digests = p.pop("digests")
+    p["log_offset"] = cur["log_offset"] if log_offset is None else log_offset
+    _atomic_write_json(_gen_dir(day_dir, p["gen"]) / "manifest.json", p)
+    _atomic_write_json(Path(day_dir) / "current.json", {"gen": p["gen"]})
+    _GEN_MANIFESTS[key] = p
+    _WRITTEN_DIGESTS.update(digests)
+    if cur["gen"] == 0:
+        _remove_legacy_views(day_dir)
+    _gc_generations(day_dir, p)
+    return p["gen"]
+
+def _publish_abort(day_dir: Path) -> None:
+    """Kassér en halvt opbygget generation (fx efter en fejl midt i en poll)."""
+    p = _GEN_PENDING.pop(str(day_dir), None)
+    if p is not None:
+        shutil.rmtree(_gen_dir(day_dir, p["gen"]), ignore_errors=True)
+
+def _gc_generations(day_dir: Path, m: dict) -> None:
+    """
+    Slet generationer uden for de seneste OBS_GEN_KEEP, som ingen af de bevarede manifester
+    peger ind i – en læser med en ældre pointer kan dermed stadig hente hele sin generation.
+    """
+    live: Set[int] = set(m["files"].values()) | {m["gen"]}
+    for g in range(max(1, m["gen"] - OBS_GEN_KEEP), m["gen"]):
+        try:
+            old = json.loads((_gen_dir(day_dir, g) / "manifest.json").read_text(encoding="utf-8"))
+            live |= {g, *(int(v) for v in (old.get("files") or {}).values())}
+        except FileNotFoundError:
+            continue  # aldrig committet (afbrudt poll)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"[Advarsel] Manifest for generation {g} i {day_dir} ulæseligt – springer oprydning over: {e}",
+                  file=sys.stderr)
+            return
+    try:
+        names = [d.name for d in (Path(day_dir) / "gen").iterdir()]
+    except OSError:
+        return
+    for name in names:
+        if name.isdigit() and int(name) not in live:
+            shutil.rmtree(Path(day_dir) / "gen" / name, ignore_errors=True)
+
+def _remove_legacy_views(day_dir: Path) -> None:
+    """Efter første generation: fjern views i det gamle layout direkte under dagsmappen."""
+    day_dir = Path(day_dir)
+    for p in [day_dir / "views.offset", *day_dir.glob("index.json*")]:
+        try:
+            p.unlink()
+        except OSError:
+            pass
+    shutil.rmtree(day_dir / "threads", ignore_errors=True)
+
 def _atomic_write_json(path: Path, obj):
     path = Path(path)
     _ensure_dir(path.parent)
@@ -194,14 +426,46 @@ def _kategori_from_row(row) -> str:
     if isinstance(val, dict): val = val.get("kategori") or val.get("cat") or val.get("type") or ""
     return str(val or "").strip().lower()
 
+# Typede kolonner afledt én gang pr. DataFrame (læses af events, build_mask og CLI-output)
+_TYPED_COLS = ("_antal_num", "_ts_obs", "_ts_obs_iso", "_tid_min", "_lon", "_lat")
+
+def _coord_series(df: pd.DataFrame, obs_col: str, lok_col: str) -> pd.Series:
+    """Koordinat som float32: obs-værdien, ellers lokalitetens; ulæselig/manglende → NaN."""
+    obs = _str_series(df, obs_col)
+    v = obs.where(obs.ne(""), _str_series(df, lok_col))
+    return pd.to_numeric(v.str.replace(",", ".", regex=False), errors="coerce").astype("float32")
+
+def _ensure_typed(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Tilføj typede kolonner (kolonnevis, én gang pr. DataFrame):
+      _antal_num  – float (som _parse_antal)
+      _ts_obs_iso – observationstidspunkt som ISO-streng (som _row_ts_obs_iso)
+      _ts_obs     – samme tidspunkt som datetime64 i DK-tid
+      _tid_min    – Obstidfra som minutter efter midnat (NaN hvis ingen tid)
+      _lon/_lat   – float32-koordinater (obs, ellers lok; NaN hvis ingen)
+    """
+    if all(c in df.columns for c in _TYPED_COLS):
+        return df
+    df = df.copy()
+    if "_antal_num" not in df.columns:
+        df["_antal_num"] = _antal_num_series(df["Antal"]) if "Antal" in df.columns else None
+    if "_ts_obs_iso" not in df.columns or "_ts_obs" not in df.columns:
+        df["_ts_obs_iso"] = _ts_obs_iso_series(df)
+        df["_ts_obs"] = _iso_to_datetime_series(df["_ts_obs_iso"])
+    if "_tid_min" not in df.columns:
+        df["_tid_min"] = _map_unique(_get_series(df, "Obstidfra"), _time_minutes).astype("float64")
+    if "_lon" not in df.columns or "_lat" not in df.columns:
+        df["_lon"] = _coord_series(df, "obs_laengdegrad", "lok_laengdegrad")
+        df["_lat"] = _coord_series(df, "obs_breddegrad", "lok_breddegrad")
+    return df
+
 def _ensure_kategori(df: pd.DataFrame) -> pd.DataFrame:
+    """Sikr typede kolonner og 'kategori' (kolonnevis; springes over hvis allerede beregnet)."""
+    df = _ensure_typed(df)
+    if "kategori" in df.columns and df["kategori"].dtype == object:
+        return df
     df = df.copy()
-    df["_antal_num"] = df["Antal"].apply(_parse_antal) if "Antal" in df.columns else None
-    if "kategori" not in df.columns or df["kategori"].dtype != object:
-        df["kategori"] = df.apply(_kategori_from_row, axis=1)
-    else:
-        # normalisér til ren str
-        df["kategori"] = df["kategori"].astype(str).str.lower()
+    df["kategori"] = art_kategori_frame(df, df["_antal_num"] if "Antal" in df.columns else None)
     return df
 
 def _parse_date_any(s: str) -> dt.date | None:
@@ -268,6 +532,36 @@ def _row_ts_obs_iso(row) -> str:
         return dt.datetime.combine(d, dt.time(0, 0, 0), tzinfo=DK_TZ).isoformat()
     return ""
 
+_TS_COLS = ("Dato-tid", "DatoTid", "Dato", "Obstidfra", "Turtidfra", "Obstidtil", "Turtidtil")
+
+def _ts_obs_iso_series(df: pd.DataFrame) -> pd.Series:
+    """_row_ts_obs_iso for alle rækker: parses én gang pr. unik kombination af dato/tid-felter."""
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    present = [c for c in _TS_COLS if c in df.columns]
+    key = _str_series(df, present[0]) if present else pd.Series("", index=df.index)
+    for c in present[1:]:
+        key = key + "\x1f" + _str_series(df, c)
+    def _parse(k: str) -> str:
+        return _row_ts_obs_iso(dict(zip(present, k.split("\x1f"))))
+    return _map_unique(key, _parse)
+
+def _iso_to_datetime_series(s: pd.Series) -> pd.Series:
+    """ISO-strenge (med offset) → datetime64 i DK-tid; tomme → NaT."""
+    uniq = pd.unique(s.fillna(""))
+    conv = pd.to_datetime(pd.Series(uniq), errors="coerce", utc=True, format="ISO8601").dt.tz_convert(DK_TZ)
+    return s.fillna("").map(dict(zip(uniq, conv))).astype(conv.dtype)
+
+def _time_minutes(s: str) -> Optional[float]:
+    t = _parse_time_any(s)
+    return (t.hour * 60 + t.minute + t.second / 60) if t else None
+
+def _rule_minutes(v) -> Optional[float]:
+    """Tid fra klientregel → minutter (YAML kan læse ucitérede 07:00 som sexagesimal int = minutter)."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return float(v)
+    return _time_minutes(str(v or ""))
+
 # Stop skrivning af enkeltfiler i events/
 def _write_event_upsert(day_dir, thread_id, ev):
     return False
@@ -275,7 +569,7 @@ def _write_event_upsert(day_dir, thread_id, ev):
 # Byg ét event-objekt (inkl. rå kolonner)
 def _build_event_from_row(row) -> dict:
     try:
-        raw = row.to_dict()
+        raw = {k: v for k, v in row.to_dict().items() if k not in _TYPED_COLS or k == "_antal_num"}
     except Exception:
         raw = {}
 
@@ -308,7 +602,7 @@ def _build_event_from_row(row) -> dict:
         "kategori": row.get("kategori"),
         "adf": adf,
         "observer": observer.strip() or None,
-        "ts_obs": _row_ts_obs_iso(row),
+        "ts_obs": ts_obs if (ts_obs := row.get("_ts_obs_iso")) is not None else _row_ts_obs_iso(row),
         "ts_seen": dt.datetime.now(DK_TZ).isoformat(),
         # NYT: noter som top-level felter
         "turnoter": turnoter if turnoter else None,
@@ -457,6 +751,13 @@ def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[di
 def _thread_id_for(row: pd.Series) -> str:
     return f"{_slugify(row.get('Artnavn',''))}-{str(row.get('Loknr','')).strip()}"
 
+def _thread_ids(df: pd.DataFrame) -> pd.Series:
+    """_thread_id_for for alle rækker (slug beregnes én gang pr. artsnavn)."""
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    art = _map_unique(_get_series(df, "Artnavn"), _slugify)
+    return art + "-" + _str_series(df, "Loknr").str.strip()
+
 def _write_event_if_new(base_dir: Path, thread_id: str, ev: dict) -> bool:
     evdir = base_dir / "threads" / thread_id / "events"
     _ensure_dir(evdir)
@@ -481,11 +782,19 @@ def _read_json_safe(p: Path) -> dict:
     except Exception:
         return {}
 
-def _json_equal(a, b) -> bool:
-    try:
-        return json.dumps(a, sort_keys=True, ensure_ascii=False) == json.dumps(b, sort_keys=True, ensure_ascii=False)
-    except Exception:
-        return False
+# Event-felter som thread.js viser; rå DOFbasen-kolonner ligger i threads/<id>/raw.json
+_THREAD_EVENT_FIELDS = ("event_type", "obsid", "art", "lok", "region", "antal_num", "antal_text", "kategori",
+                        "adf", "observer", "ts_obs", "ts_seen", "turnoter", "fuglnoter")
+
+def _slim_event(ev: dict) -> dict:
+    return {k: ev[k] for k in _THREAD_EVENT_FIELDS if k in ev}
+
+def _write_thread_raw(day_dir: Path, thread_id: str, evs_for_thread: list[dict]) -> None:
+    """Skriv sidecar med rå CSV-rækker for tråden (én pr. obsid), som thread.js henter ved behov."""
+    rows = {_event_key(e): {k: v for k, v in e["raw"].items() if not (isinstance(v, float) and v != v)}
+            for e in (evs_for_thread or []) if e.get("raw")}  # tomme (NaN) celler udelades
+    _publish_json(day_dir, f"threads/{thread_id}/raw.json",
+                  {"version": 1, "thread_id": thread_id, "rows": rows}, artifact=False)
 
 # NYT: map tråd -> index-item (samme felter som observations-/trådlister bruger)
 def _index_item_from_thread(thread: dict) -> dict:
@@ -515,10 +824,9 @@ def _index_item_from_thread(thread: dict) -> dict:
     }
 
 # Byg trådsammenfatning og skriv thread.json med ALLE events.
-def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[dict], date_ymd: str) -> dict:
-    tdir = Path(day_dir) / "threads" / thread_id
-    _ensure_dir(tdir)
-    tpath = tdir / "thread.json"
+def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[dict], date_ymd: str,
+                          digest: Optional[str] = None, withdrawn: bool = False) -> dict:
+    rel = f"threads/{thread_id}/thread.json"
 
     def ts(e: dict) -> str:
         return e.get("ts_obs") or e.get("ts_seen") or ""
@@ -529,7 +837,7 @@ def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[di
             "day": date_ymd, "thread_id": thread_id, "status": "withdrawn",
             "num_events": 0, "has_nonzero_today": False
         }, "events": [], "stats": {"num_events": 0}}
-        _atomic_write_json(tpath, payload)
+        _publish_json(day_dir, rel, payload)
         return payload["thread"]
 
     # Sorteringer
@@ -589,14 +897,16 @@ def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[di
         "last_ts_obs": last_ts_obs,
         "last_active_ts_obs": last_active_ts_obs,
         "last_kategori": last_kategori,
-        "status": "active",
+        "status": "withdrawn" if withdrawn else "active",
         "max_antal_num": max_antal_num,
         "last_antal_num": last_antal_num,
         "num_events": len(events),
-        "has_nonzero_today": has_nonzero_today,
+        "has_nonzero_today": has_nonzero_today and not withdrawn,
         "last_adf": last_event.get("adf"),
         "last_observer": last_event.get("observer"),
     }
+    if digest:
+        thread["digest"] = digest  # indholds-digest for trådens rækker (dirty-tracking)
 
     # NYT: Hvis kun én observation i tråden, medtag noter i thread
     if len(events_desc) == 1:
@@ -620,90 +930,20 @@ def _update_thread_rollup(day_dir: Path, thread_id: str, evs_for_thread: list[di
         "max_antal_ts_obs": (max_item or {}).get("ts_obs"),
     }
 
-    # NYT: thread.json indeholder både sammendrag og ALLE events
+    # thread.json indeholder sammendrag og ALLE events (uden rå kolonner, se raw.json)
     payload = {
         "version": 2,
         "thread": thread,
-        "events": events_desc,  # alle observationer for art × lokalitet (den dag)
+        "events": [_slim_event(e) for e in events_desc],  # alle observationer for art × lokalitet (den dag)
         "stats": stats,
     }
 
-    _atomic_write_json(tpath, payload)
+    _publish_json(day_dir, rel, payload)
     return thread
 
-def _write_events_all(day_dir: Path, thread_id: str, thread: dict, evs_for_thread: list[dict], date_ymd: str) -> bool:
-    """
-    Skriv samlet fil med alle events for tråden:
-    web/obs/<YYYY-MM-DD>/threads/<thread_id>/events.all.json
-    Returnerer True hvis filen blev skrevet/ændret.
-    """
-    path = Path(day_dir) / "threads" / thread_id / "events.all.json"
-    _ensure_dir(path.parent)
-
-    # Pak relevante event-felter og sorter nyeste først
-    events = []
-    for ev in evs_for_thread:
-        if ev.get("event_type") != "obs":
-            continue
-        events.append({
-            "obsid": ev.get("obsid"),
-            "ts_obs": ev.get("ts_obs") or ev.get("ts_seen"),
-            "antal_num": ev.get("antal_num"),
-            "antal_text": ev.get("antal_text"),
-            "kategori": ev.get("kategori"),
-            "adf": ev.get("adf"),
-            "observer": ev.get("observer"),
-        })
-    events.sort(key=lambda e: e.get("ts_obs") or "", reverse=True)
-
-    # Stats
-    max_item = None
-    for e in events:
-        v = e.get("antal_num")
-        if isinstance(v, (int, float)):
-            if (max_item is None) or (v > (max_item.get("antal_num") or float("-inf"))):
-                max_item = e
-    stats = {
-        "num_events": len(events),
-        "max_antal_num": (max_item or {}).get("antal_num"),
-        "max_antal_ts_obs": (max_item or {}).get("ts_obs"),
-    }
-
-    # Tråd-metadata (subset)
-    payload = {
-        "version": 1,
-        "thread": {
-            "day": date_ymd,
-            "thread_id": thread_id,
-            "art": thread.get("art"),
-            "lok": thread.get("lok"),
-            "loknr": thread.get("loknr"),
-            "region": thread.get("region"),
-            "region_slug": thread.get("region_slug"),  # NYT
-            "coords": thread.get("coords"),
-            "first_ts_obs": thread.get("first_ts_obs"),
-            "last_ts_obs": thread.get("last_ts_obs"),
-            "status": thread.get("status"),
-        },
-        "events": events,
-        "stats": stats,
-    }
-
-    old = None
-    if path.exists():
-        try:
-            old = json.loads(path.read_text(encoding="utf-8"))
-        except Exception:
-            old = None
-
-    if old is None or not _json_equal(old, payload):
-        _atomic_write_json(path, payload)
-        return True
-    return False
-
 def _write_index_for_day(day_dir: Path, threads: list[dict], date_ymd: str) -> bool:
     """
-    Skriv web/obs/<date>/index.json som pæn, multilinjers JSON.
+    Skriv web/obs/<date>/index.json (minificeret + .gz/.br/.etag, se _write_json_artifact).
     """
     items = []
     for t in (threads or []):
@@ -714,16 +954,7 @@ def _write_index_for_day(day_dir: Path, threads: list[dict], date_ymd: str) -> b
     # Nyeste først
     items.sort(key=lambda x: x.get("last_ts_obs") or "", reverse=True)
 
-    path = Path(day_dir) / "index.json"
-    old = None
-    if path.exists():
-        try: old = json.loads(path.read_text(encoding="utf-8"))
-        except Exception: old = None
-
-    if old is None or not _json_equal(old, items):
-        _atomic_write_json_pretty(path, items)
-        return True
-    return False
+    return _publish_json(day_dir, "index.json", items)
 
 def _purge_old_obs(retain_days: int = 2):
     base = OBS_BASE
@@ -745,6 +976,9 @@ def _purge_old_obs(retain_days: int = 2):
         keep = {today}
     for dname in dates:
         if dname not in keep:
+            prefix = str(base / dname) + os.sep
+            for k in [k for k in _WRITTEN_DIGESTS if k.startswith(prefix)]:
+                del _WRITTEN_DIGESTS[k]
             try:
                 for pp in (base / dname).rglob("*"):
                     try:
@@ -768,64 +1002,314 @@ def _send_withdraw_push(thread: dict, server_url: str = "http://localhost:8000/a
         title = f"Tilbagekaldt: {thread.get('art','')} – {thread.get('lok','')}"
         last_pos = thread.get("last_active_ts_obs") or thread.get("last_ts_obs")
         body = f"Dagens observation(er) rettet til 0 / fjernet. Sidst positivt: {last_pos}"
-        link = f"/thread.html?date={thread.get('first_ts_obs','')[:10]}&id={thread.get('thread_id','')}"
+        link = f"/thread.html?date={(thread.get('first_ts_obs') or '')[:10]}&id={thread.get('thread_id','')}"
         payload = {
             "title": title, "body": body, "url": link,
             "tag": f"withdraw-{thread.get('thread_id')}",
-            "urgency": "normal"
+            "urgency": "normal",
         }
-        requests.post(url, json=payload, timeout=(3.05, 15))
-    except Exception:
-        pass
-
-def build_obs_storage_for_day(df: pd.DataFrame, date_ymd: str, *, categories: tuple[str,...]=("su","sub"), send_withdraw_push: bool = True):
-    if df.empty:
-        _ensure_dir(OBS_BASE / date_ymd)
-        _atomic_write_json((OBS_BASE / date_ymd / "index.json"), [])
-        return
+        outbox_put(url, payload, (3.05, 15))
+    except Exception as e:
+        print(f"[webpush] Kunne ikke lægge tilbagekaldelse i outbox: {e}", file=sys.stderr)
+
+# ─── Dagslog (append-only) ───
+# web/obs/<dag>/events.log har én JSON-linje pr. observations-ændring, skrevet præcis én gang:
+#   {"op":"insert"|"update","tid":…,"key":…,"ev":{…}}   {"op":"delete","tid":…,"key":…}
+#   {"op":"withdraw","tid":…}   {"op":"restore","tid":…}   {"op":"digest","tid":…,"digest":…}
+# digest-posten er trådens række-digest (se _thread_digests), så dirty-tracking overlever
+# genstart og rebuild; den ændrer ikke trådens events.
+# thread.json og index.json er materialiserede views af loggen, publiceret som generationer
+# (se _publish_commit). Generationens log_offset er den byte-position i loggen, som views er
+# bygget til; en afbrudt kørsel genoptager derfra.
+DAY_LOG_NAME = "events.log"
+
+# Dagens materialiserede event-tilstand: {"events": {tid: {key: ev}}, "withdrawn": {tid}, "digests": {tid: digest}}
+_DAY_EVENTS: Dict[str, dict] = {}
+
+def _event_sig(ev: dict) -> str:
+    # ts_seen ændres ved hver opbygning og tæller ikke som en ændring af observationen
+    return json.dumps({k: v for k, v in ev.items() if k != "ts_seen"}, ensure_ascii=False, sort_keys=True, default=str)
+
+def _event_key(ev: dict) -> str:
+    oid = ev.get("obsid")
+    return str(oid) if oid else "h-" + hashlib.sha1(_event_sig(ev).encode("utf-8")).hexdigest()[:16]
+
+def _apply_log_record(day: dict, rec: dict) -> Optional[str]:
+    """Anvend én log-post på dagens event-tilstand; returnerer berørt tråd-id."""
+    tid, op = rec.get("tid"), rec.get("op")
+    if not tid:
+        return None
+    if op in ("insert", "update"):
+        day["events"].setdefault(tid, {})[rec["key"]] = rec["ev"]
+    elif op == "delete":
+        day["events"].get(tid, {}).pop(rec.get("key"), None)
+    elif op == "withdraw":
+        day["events"].setdefault(tid, {})
+        day["withdrawn"].add(tid)
+    elif op == "restore":
+        day["withdrawn"].discard(tid)
+    elif op == "digest":
+        day.setdefault("digests", {})[tid] = rec.get("digest")
+        return None  # views uændrede; registret får digest i _load_day
+    else:
+        return None
+    return tid
 
+def _read_day_log(day_dir: Path, start: int = 0) -> tuple[List[tuple[int, dict]], int]:
+    """
+    Læs log-poster fra byte-offset 'start'. Returnerer ([(offset efter posten, post)], slut-offset).
+    En afkortet sidste linje (crash midt i append) skæres væk som i state-loggen.
+    """
+    path = day_dir / DAY_LOG_NAME
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return [], 0
+    recs: List[tuple[int, dict]] = []
+    good = start = min(start, len(data))
+    for line in data[start:].splitlines(keepends=True):
+        try:
+            rec = json.loads(line) if line.endswith(b"\n") else None
+        except Exception:
+            rec = None
+        if not isinstance(rec, dict):
+            break
+        good += len(line)
+        recs.append((good, rec))
+    if good < len(data):
+        print(f"[Advarsel] {path} afkortet efter {good} bytes (ufuldstændig skrivning).", file=sys.stderr)
+        with path.open("r+b") as f:
+            f.truncate(good)
+    return recs, good
+
+def _append_day_log(day_dir: Path, recs: List[dict]) -> int:
+    """Tilføj poster til dagsloggen i én sekventiel skrivning (fsync); returnerer ny længde."""
+    data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in recs)
+    with (day_dir / DAY_LOG_NAME).open("ab") as f:
+        f.write(data.encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+def _views_offset(day_dir: Path) -> int:
+    # Gammelt layout (generation 0) har ingen offset: hele loggen materialiseres i generation 1
+    return _current_manifest(day_dir)["log_offset"]
+
+def _seed_day_log(day_dir: Path, registry: Dict[str, dict]) -> List[dict]:
+    """Dag bygget før dagsloggen fandtes: skriv eksisterende thread.json-views ind i loggen."""
+    recs: List[dict] = []
+    for tid in registry:
+        tpath = _view_path(day_dir, f"threads/{tid}/thread.json")
+        payload = _load_prev_thread_payload(tpath) if tpath else {}
+        for ev in reversed(payload.get("events") or []):  # views er nyeste først
+            if isinstance(ev, dict):
+                recs.append({"op": "insert", "tid": tid, "key": _event_key(ev), "ev": ev})
+        if registry[tid].get("status") == "withdrawn":
+            recs.append({"op": "withdraw", "tid": tid})
+    if recs:
+        _append_day_log(day_dir, recs)
+        print(f"[obs] {day_dir.name}: dagslog oprettet fra {len(registry)} eksisterende tråde ({len(recs)} poster)")
+    return recs
+
+def _materialize_thread(day_dir: Path, date_ymd: str, tid: str, day: dict, rows_changed: bool = True) -> dict:
+    evs = list(day["events"].get(tid, {}).values())
+    withdrawn = tid in day["withdrawn"]
+    digest = day.get("digests", {}).get(tid)
+    if rows_changed:
+        _write_thread_raw(day_dir, tid, evs)
+    return _update_thread_rollup(day_dir, tid, evs, date_ymd, digest=None if withdrawn else digest, withdrawn=withdrawn)
+
+def _diff_thread_events(tid: str, old: Dict[str, dict], evs: List[dict]) -> tuple[List[dict], Dict[str, dict]]:
+    """Log-poster for trådens aktuelle events mod de materialiserede; returnerer (poster, nyt event-map)."""
+    recs: List[dict] = []
+    new: Dict[str, dict] = {}
+    for ev in evs:
+        key = _event_key(ev)
+        prev = old.get(key)
+        if prev is not None and _event_sig(prev) == _event_sig(ev):
+            new[key] = prev  # uændret: behold første ts_seen
+            continue
+        recs.append({"op": "insert" if prev is None else "update", "tid": tid, "key": key, "ev": ev})
+        new[key] = ev
+    recs += [{"op": "delete", "tid": tid, "key": key} for key in old if key not in new]
+    return recs, new
+
+# Trådregister for dagen (thread_id -> trådsammendrag inkl. status, has_nonzero_today
+# og digest). Indlæses fra disk én gang pr. proces/dag og opdateres derefter kun
+# inkrementelt, så withdrawn-detektion er en mængdedifference i hukommelsen.
+_THREAD_REGISTRY: Dict[str, Dict[str, dict]] = {}
+
+def _load_thread_registry(day_dir: Path) -> Dict[str, dict]:
+    reg: Dict[str, dict] = {}
+    m = _current_manifest(day_dir, refresh=True)
+    if m["gen"]:
+        paths = {rel.split("/")[1]: _gen_dir(day_dir, g) / rel for rel, g in m["files"].items()
+                 if rel.startswith("threads/") and rel.endswith("/thread.json")}
+    else:
+        threads_dir = day_dir / "threads"
+        paths = {t.name: t / "thread.json" for t in threads_dir.iterdir() if t.is_dir()} \
+            if threads_dir.exists() else {}
+    for tid, tpath in paths.items():
+        thread = _load_prev_thread_payload(tpath).get("thread")
+        if isinstance(thread, dict):
+            reg[tid] = thread
+    return reg
+
+def _load_day(day_dir: Path, date_ymd: str) -> tuple[Dict[str, dict], dict]:
+    """
+    Indlæs trådregister (fra views) og event-tilstand (fra dagsloggen). Poster efter
+    generationens log_offset – fra en kørsel der stoppede før views blev publiceret –
+    materialiseres nu i en ny generation.
+    """
+    registry = _load_thread_registry(day_dir)
+    day = {"events": {}, "withdrawn": set(), "digests": {}}
+    recs, end = _read_day_log(day_dir)
+    if not recs and registry:
+        _seed_day_log(day_dir, registry)
+        recs, end = _read_day_log(day_dir)
+    offset = _views_offset(day_dir)
+    tail: Set[str] = set()
+    for pos, rec in recs:
+        tid = _apply_log_record(day, rec)
+        if tid and pos > offset:
+            tail.add(tid)
+    for tid, d in day["digests"].items():  # loggens digest gælder, også hvor view ikke blev skrevet om
+        if tid in registry and tid not in day["withdrawn"]:
+            registry[tid] = dict(registry[tid], digest=d)
+    if tail or (recs and offset != end):
+        for tid in tail:
+            registry[tid] = _materialize_thread(day_dir, date_ymd, tid, day)
+        ordered = [registry[t] for t in day["events"] if t in registry]  # log-rækkefølge som ved rebuild
+        ordered += [t for tid, t in registry.items() if tid not in day["events"]]
+        _write_index_for_day(day_dir, ordered, date_ymd)
+        _publish_commit(day_dir, log_offset=end)
+        print(f"[obs] {date_ymd}: genoptog views fra log-offset {offset} ({len(tail)} tråde)")
+    return registry, day
+
+def _thread_registry(day_dir: Path, date_ymd: str) -> tuple[Dict[str, dict], dict, bool]:
+    """Returnér (register, event-tilstand, frisk_indlæst) for dagen; andre dage smides ud."""
+    for d in [d for d in _THREAD_REGISTRY if d != date_ymd]:
+        _THREAD_REGISTRY.pop(d, None)
+    for d in [d for d in _DAY_EVENTS if d != date_ymd]:
+        _DAY_EVENTS.pop(d, None)
+    reg = _THREAD_REGISTRY.get(date_ymd)
+    if reg is not None and date_ymd in _DAY_EVENTS:
+        return reg, _DAY_EVENTS[date_ymd], False
+    reg, day = _load_day(day_dir, date_ymd)
+    _THREAD_REGISTRY[date_ymd], _DAY_EVENTS[date_ymd] = reg, day
+    return reg, day, True
+
+def rebuild_day_views(date_ymd: str) -> int:
+    """Genskab alle thread.json + index.json for en dag ud fra dagsloggen alene."""
+    day_dir = OBS_BASE / date_ymd
+    recs, end = _read_day_log(day_dir)
+    if not recs:
+        print(f"[Advarsel] Ingen dagslog i {day_dir / DAY_LOG_NAME} – intet at genopbygge.", file=sys.stderr)
+        return 1
+    t0 = time.perf_counter()
+    day = {"events": {}, "withdrawn": set(), "digests": {}}
+    for _, rec in recs:
+        _apply_log_record(day, rec)
+    registry = {tid: _materialize_thread(day_dir, date_ymd, tid, day) for tid in day["events"]}
+    _write_index_for_day(day_dir, list(registry.values()), date_ymd)
+    _publish_commit(day_dir, log_offset=end)
+    _THREAD_REGISTRY.pop(date_ymd, None)
+    _DAY_EVENTS.pop(date_ymd, None)
+    print(f"[obs] {date_ymd}: {len(registry)} tråde genopbygget fra {len(recs)} log-poster "
+          f"({(time.perf_counter() - t0) * 1000:.1f} ms)")
+    return 0
+
+def build_obs_storage_for_day(df: pd.DataFrame, date_ymd: str, *, categories: tuple[str,...]=("su","sub"),
+                              send_withdraw_push: bool = True, delta: Optional[dict] = None):
+    """
+    Byg/opdatér web/obs/<date>/ (events.log + views: thread.json pr. tråd og index.json).
+    Med 'delta' (fra compute_row_delta) diffes kun berørte tråde; ændrede observationer
+    appendes til dagsloggen, og kun tråde med nye log-poster materialiseres igen. Tråde
+    der forsvinder fra CSV'en markeres withdrawn (og der sendes evt. tilbagekaldelses-push).
+    """
     day_dir = OBS_BASE / date_ymd
     _ensure_dir(day_dir)
+    if df.empty:
+        _THREAD_REGISTRY.pop(date_ymd, None)
+        _publish_json(day_dir, "index.json", [])
+        _publish_commit(day_dir)
+        return
 
     df = _ensure_kategori(df)
     rows = df[df["kategori"].isin(categories)]
+    tids = _thread_ids(rows)
+    order = pd.unique(tids)
+    present = set(order)
+
+    registry, day, fresh = _thread_registry(day_dir, date_ymd)
+    if delta is not None and not delta.get("full") and not fresh:
+        candidates = set(delta.get("threads") or ()) & present
+    else:
+        candidates = present
+
+    # Dirty-tracking: tråde hvis indholds-digest er uændret diffes ikke
+    digests = (delta or {}).get("thread_digests") or {}
+    dirty: set = set()
+    unchanged = 0
+    for tid in candidates:
+        d = digests.get(tid)
+        prev = registry.get(tid) or {}
+        if d and prev.get("digest") == d and prev.get("status") != "withdrawn":
+            unchanged += 1
+            continue
+        dirty.add(tid)
+    sel = tids.isin(dirty)
+    rows, tids_sel = rows[sel], tids[sel]
 
     thread_events: dict[str, list[dict]] = {}
 
-    for _, r in rows.iterrows():
-        ev = _build_event_from_row(r)
-        tid = _thread_id_for(r)  # art × lokalitet
+    for (_, r), tid in zip(rows.iterrows(), tids_sel):
+        ev = _build_event_from_row(r)  # tid: art × lokalitet
         thread_events.setdefault(tid, []).append(ev)
 
-    threads_out: list[dict] = []
+    # Diff mod dagens materialiserede events → log-poster (kun reelle ændringer)
+    recs: List[dict] = []
+    new_maps: Dict[str, Dict[str, dict]] = {}
     for tid, evs in thread_events.items():
-        thread = _update_thread_rollup(day_dir, tid, evs, date_ymd)
-        threads_out.append(thread)
-
-    # Markér withdrawn for tråde, der mangler i denne sync
-    present = set(thread_events.keys())
-    threads_dir = day_dir / "threads"
-    if threads_dir.exists():
-        for tdir in threads_dir.iterdir():
-            if not tdir.is_dir(): continue
-            tid = tdir.name
-            if tid in present: continue
-            tpath = tdir / "thread.json"
-            if not tpath.exists(): continue
-            try:
-                before = json.loads(tpath.read_text(encoding="utf-8"))
-            except Exception:
-                continue
-            if before.get("has_nonzero_today") and before.get("status") != "withdrawn":
-                before["has_nonzero_today"] = False
-                before["status"] = "withdrawn"
-                _atomic_write_json(tpath, before)
-
-    # Skriv dagsindex (med alle nødvendige felter til thread.js liste)
-    _write_index_for_day(day_dir, threads_out, date_ymd)
-
-    # Debug: antal tråde (fjern 'writes' som ikke længere bruges)
-    print(f"[obs] {date_ymd}: threads={len(thread_events)}")
+        r, new = _diff_thread_events(tid, day["events"].get(tid, {}), evs)
+        if tid in day["withdrawn"]:
+            r.insert(0, {"op": "restore", "tid": tid})
+        if r or tid not in registry:
+            recs += r
+            new_maps[tid] = new
+        else:
+            registry[tid] = dict(registry[tid], digest=digests.get(tid))  # kun digest er nyt
+        if digests.get(tid) and day["digests"].get(tid) != digests[tid]:
+            recs.append({"op": "digest", "tid": tid, "digest": digests[tid]})
+
+    # Withdrawn: aktive tråde i registret, der mangler i denne sync
+    gone = [tid for tid, t in registry.items() if tid not in present and t.get("status") != "withdrawn"]
+    recs += [{"op": "withdraw", "tid": tid} for tid in gone]
+
+    touched: Set[str] = set(new_maps)
+    rows_changed = {rec["tid"] for rec in recs if rec["op"] in ("insert", "update", "delete")}
+    rows_changed |= {tid for tid in new_maps if tid not in registry}  # view mangler helt
+    if recs:
+        end = _append_day_log(day_dir, recs)
+        touched.update(tid for rec in recs if (tid := _apply_log_record(day, rec)))
+        day["events"].update(new_maps)  # samme indhold, men i CSV-rækkefølge
+    before = {tid: registry[tid] for tid in gone}
+    for tid in touched:
+        registry[tid] = _materialize_thread(day_dir, date_ymd, tid, day, rows_changed=tid in rows_changed)
+    for tid in gone:
+        if send_withdraw_push and before[tid].get("has_nonzero_today"):
+            _send_withdraw_push(registry[tid])
+
+    if touched or fresh:
+        # Dagens tråde i samme rækkefølge som i CSV'en; tilbagekaldte sidst
+        threads_out: list[dict] = [registry[t] for t in order if t in registry]
+        threads_out += [t for tid, t in registry.items() if tid not in present]
+        _write_index_for_day(day_dir, threads_out, date_ymd)
+    gen = _publish_commit(day_dir, log_offset=end if recs else None)
+
+    # Debug: antal tråde, log-poster, materialiserede views, uændrede og tilbagekaldte
+    print(f"[obs] {date_ymd}: threads={len(registry)} logged={len(recs)} touched={len(touched)} "
+          f"unchanged={unchanged} withdrawn={len(gone)} gen={gen if gen is not None else '-'}")
 
 # ───────────────────────────────── Utilities ─────────────────────────────────
 def ensure_dirs():
@@ -840,25 +1324,108 @@ def build_url(date_dd_mm_yyyy: str) -> str:
         raise SystemExit(f"Ugyldig dato '{date_dd_mm_yyyy}' (forventet DD-MM-YYYY)") from e
     return DOF_URL.format(dato=date_dd_mm_yyyy)
 
-def fetch_csv(url: str) -> Optional[Path]:
-    ts = dt.datetime.now(DK_TZ).strftime("%Y%m%d_%H%M%S")
-    dest = DL_DIR / f"search_result_{ts}.csv"
+# Validatorer (ETag/Last-Modified) + sha256 for sidst fuldt behandlede svar pr. URL
+_FETCH_CACHE: Dict[str, dict] = {}
+
+def fetch_csv(url: str) -> Tuple[Optional[bytes], dict]:
+    """
+    Hent CSV i hukommelsen (betinget request hvis vi kender validatorer fra sidste svar).
+    Returnerer (indhold, meta); meta['status'] er 'ok', 'unchanged' eller 'error'.
+    Ved 'unchanged' (304 eller samme sha256 som sidst) returneres intet indhold.
+    """
     headers = {"User-Agent": "birdnotification/1.7 (+local)"}
+    prev = _FETCH_CACHE.get(url) or {}
+    if prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
     try:
-        with requests.get(url, headers=headers, timeout=60) as r:
+        with requests.get(url, headers=headers, timeout=60, stream=True) as r:
+            if r.status_code == 304 and prev:
+                return None, dict(prev, status="unchanged", http=304)
             r.raise_for_status()
-            dest.write_bytes(r.content)
-            return dest
+            buf = bytearray()
+            h = hashlib.sha256()
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                if chunk:
+                    h.update(chunk)
+                    buf += chunk
+            meta = {
+                "status": "ok",
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "sha256": h.hexdigest(),
+                "bytes": len(buf),
+            }
+            if prev.get("sha256") == meta["sha256"]:
+                return None, dict(meta, status="unchanged", http=200)
+            return bytes(buf), meta
     except requests.RequestException as e:
         print(f"[Advarsel] Kunne ikke hente CSV: {e}", file=sys.stderr)
-        return None
+        return None, {"status": "error"}
+
+def _remember_fetch(url: str, meta: dict) -> None:
+    """Gem validatorer/sha256 – kaldes først når hele pipelinen er gennemført."""
+    if meta and meta.get("sha256"):
+        _FETCH_CACHE[url] = {k: meta.get(k) for k in ("etag", "last_modified", "sha256", "bytes")}
+
+@contextmanager
+def _timed(timings: Dict[str, float], stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - t0) * 1000
+
+def _report_timings(timings: Dict[str, float], note: str = "") -> None:
+    parts = [f"{k}={v:.0f}ms" for k, v in timings.items()]
+    parts.append(f"total={sum(timings.values()):.0f}ms")
+    print(f"[poll] {' '.join(parts)}{(' · ' + note) if note else ''}")
 
 def _trim_whitespace(df: pd.DataFrame) -> pd.DataFrame:
-    return df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    """Strip whitespace kolonnevis (kategoriske kolonner trimmes via deres kategorier)."""
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            cats = s.cat.categories
+            if cats.dtype != object:
+                continue
+            stripped = cats.str.strip()
+            if stripped.equals(cats):
+                continue
+            if stripped.is_unique:
+                df[c] = s.cat.rename_categories(stripped)
+            else:
+                df[c] = s.astype(object).str.strip().astype("category")
+        elif s.dtype == object:
+            df[c] = s.str.strip().fillna(s)  # ikke-str værdier bevares uændret
+    return df
 
 def _get_series(df: pd.DataFrame, col: str) -> pd.Series:
     return df[col] if col in df.columns else pd.Series([""] * len(df), index=df.index)
 
+def _str_series(df: pd.DataFrame, col: str) -> pd.Series:
+    """Kolonne som object-str (også for kategoriske kolonner); manglende værdier → ''."""
+    s = _get_series(df, col)
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        s = s.astype(object)
+    return s.fillna("").astype(str)
+
+def _map_unique(s: pd.Series, fn) -> pd.Series:
+    """
+    Anvend fn én gang pr. unik værdi i s (i stedet for pr. række).
+    Manglende værdier gives til fn som ''; kategoriske kolonner mappes via deres kategorier.
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        vals = np.array([fn(c) for c in s.cat.categories] + [fn("")], dtype=object)
+        return pd.Series(vals[s.cat.codes.to_numpy()], index=s.index)  # kode -1 (NA) → fn("")
+    s = s.fillna("")
+    uniq = pd.unique(s)
+    return s.map(dict(zip(uniq, (fn(u) for u in uniq))))
+
+def _frame_mem_mb(df: pd.DataFrame) -> float:
+    return float(df.memory_usage(deep=True).sum()) / (1024 * 1024)
+
 def _inject_time_fallbacks(df: pd.DataFrame) -> pd.DataFrame:
     s_obsidfra = _get_series(df, "Obstidfra")
     s_turtidfra = _get_series(df, "Turtidfra")
@@ -868,65 +1435,179 @@ def _inject_time_fallbacks(df: pd.DataFrame) -> pd.DataFrame:
     df["Obstidtil"] = s_obsidtil.where(s_obsidtil != "", s_turtidtil)
     return df
 
-def _try_read(path: Path, encoding: str) -> pd.DataFrame:
-    df = pd.read_csv(path, sep=";", encoding=encoding, dtype=str, keep_default_na=False)
+CSV_ENCODINGS = ["utf-8", "utf-8-sig", "cp1252", "latin1"]
+# Sidst fungerende encoding pr. kilde (fx 'dofbasen.dk/excel/search_result1.php')
+_ENCODING_CACHE: Dict[str, str] = {}
+
+def _detect_encoding(prefix: bytes, known: Optional[str] = None) -> str:
+    """
+    Gæt encoding ud fra de første bytes (BOM → utf-8-sig, gyldig utf-8 → utf-8, ellers cp1252).
+    Er prefixet ren ASCII (tvetydigt), bruges kildens kendte encoding.
+    """
+    if prefix.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if prefix.isascii():
+        return known or "utf-8"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        prefix.decode("cp1252")
+        return "cp1252"
+    except UnicodeDecodeError:
+        return "latin1"
+
+def _try_read(data: bytes, encoding: str) -> pd.DataFrame:
+    dtypes = {c: ("category" if t == "category" else str) for c, t in CSV_SCHEMA.items()}
+    df = pd.read_csv(io.BytesIO(data), sep=";", encoding=encoding, dtype=dtypes, keep_default_na=False,
+                     usecols=lambda c: c in USED_COLS)
     return _trim_whitespace(df)
 
-def read_csv_with_fallback(path: Path) -> Tuple[pd.DataFrame, str]:
-    encodings = ["utf-8", "utf-8-sig", "cp1252", "latin1"]
+def read_csv_with_fallback(data, source: str = "") -> Tuple[pd.DataFrame, str]:
+    """
+    Parse DOFbasen-CSV direkte fra bytes (en Path læses først ind).
+    Encoding bestemmes én gang ud fra et byte-prefix og huskes pr. kilde;
+    de øvrige encodings bruges kun som fallback.
+    """
+    if isinstance(data, Path):
+        data = data.read_bytes()
+    first = _detect_encoding(data[:1 << 16], _ENCODING_CACHE.get(source))
+    encodings = [first] + [e for e in CSV_ENCODINGS if e != first]
     last_err = None
     for enc in encodings:
         try:
-            df = _try_read(path, enc)
+            df = _try_read(data, enc)
             missing = [c for c in REQUIRED_COLS if c not in df.columns]
             if missing:
                 raise SystemExit(f"Mangler forventede kolonner i CSV: {missing}")
-            df["group_key"] = df["Artnavn"] + "\n" + df["Loknr"]
+            df["group_key"] = _str_series(df, "Artnavn") + "\n" + _str_series(df, "Loknr")
             df = _inject_time_fallbacks(df)
+            if source:
+                _ENCODING_CACHE[source] = enc
             return df, enc
         except (UnicodeDecodeError, pd.errors.ParserError) as e:
             last_err = e
             continue
     raise SystemExit(f"Kunne ikke læse CSV med kendte encodings: {last_err}")
 
-def _region_key(text: str) -> str:
-    return (text or "").strip()
-
 # ─────────────────────── State ───────────────────────
-def load_state() -> Dict[str, dict]:
+# State holdes i hukommelsen mellem polls. På disk: snapshot (dof_state.json) +
+# append-only ændringslog (dof_state.log, én JSON-linje pr. poll), som komprimeres
+# ind i snapshottet, når loggen er vokset sig større end selve state.
+STATE_COMPACT_MIN = 500  # min. antal log-poster før komprimering
+_STATE: Optional[Dict[str, dict]] = None
+_STATE_LOG_ENTRIES = 0
+
+def _normalize_state_entry(v, today_iso: str) -> dict:
+    if isinstance(v, dict) and ("date" in v or "antal" in v):
+        antal_val = v.get("antal")
+        try:
+            if isinstance(antal_val, str):
+                antal_val = float(antal_val.replace(",", "."))
+        except Exception:
+            antal_val = None
+        return {"date": v.get("date"), "antal": antal_val}
+    return {"date": today_iso, "antal": None}
+
+def _load_state_snapshot() -> Dict[str, dict]:
     if not STATE_FILE.exists():
         return {}
     try:
         raw = json.loads(STATE_FILE.read_text(encoding="utf-8"))
-        state: Dict[str, dict] = {}
-        today_iso = dt.datetime.now(DK_TZ).date().isoformat()
         if not isinstance(raw, dict):
             return {}
-        for k, v in raw.items():
-            if isinstance(v, dict) and ("date" in v or "antal" in v):
-                date_val = v.get("date")
-                antal_val = v.get("antal")
-                try:
-                    if isinstance(antal_val, str):
-                        antal_val = float(antal_val.replace(",", "."))
-                except Exception:
-                    antal_val = None
-                state[k] = {"date": date_val, "antal": antal_val}
-            else:
-                state[k] = {"date": today_iso, "antal": None}
-        return state
+        today_iso = dt.datetime.now(DK_TZ).date().isoformat()
+        return {k: _normalize_state_entry(v, today_iso) for k, v in raw.items()}
     except Exception:
         return {}
 
-def save_state(state: Dict[str, dict]):
+def _replay_state_log(state: Dict[str, dict]) -> int:
+    """
+    Afspil ændringslog oven på snapshot. En afkortet sidste linje (crash midt i
+    skrivning) ignoreres og skæres væk, så næste append starter på en ren linje.
+    """
+    if not STATE_LOG.exists():
+        return 0
+    today_iso = dt.datetime.now(DK_TZ).date().isoformat()
+    n = 0
+    good = 0
+    try:
+        data = STATE_LOG.read_bytes()
+        for line in data.splitlines(keepends=True):
+            try:
+                rec = json.loads(line) if line.endswith(b"\n") else None
+            except Exception:
+                rec = None
+            if not isinstance(rec, dict):
+                break
+            for k, v in (rec.get("set") or {}).items():
+                state[k] = _normalize_state_entry(v, today_iso)
+            for k in rec.get("del") or ():
+                state.pop(k, None)
+            n += len(rec.get("set") or ()) + len(rec.get("del") or ())
+            good += len(line)
+        if good < len(data):
+            print(f"[Advarsel] State-log afkortet efter {good} bytes (ufuldstændig skrivning).", file=sys.stderr)
+            with STATE_LOG.open("r+b") as f:
+                f.truncate(good)
+    except Exception as e:
+        print(f"[Advarsel] Kunne ikke læse state-log: {e}", file=sys.stderr)
+    return n
+
+def load_state() -> Dict[str, dict]:
+    """State fra hukommelsen; første kald i processen genskaber den fra snapshot + log."""
+    global _STATE, _STATE_LOG_ENTRIES
+    if _STATE is None:
+        _STATE = _load_state_snapshot()
+        _STATE_LOG_ENTRIES = _replay_state_log(_STATE)
+    return _STATE
+
+def _compact_state(state: Dict[str, dict]):
+    global _STATE_LOG_ENTRIES
     _atomic_write_text(STATE_FILE, json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    # Crash mellem de to trin er ufarligt: loggen indeholder absolutte værdier
+    try:
+        STATE_LOG.unlink()
+    except FileNotFoundError:
+        pass
+    _STATE_LOG_ENTRIES = 0
+
+def save_state(state: Dict[str, dict]):
+    """Persistér kun ændringer siden sidste save_state som én log-linje."""
+    global _STATE, _STATE_LOG_ENTRIES
+    prev = load_state()
+    if not prev:
+        _STATE = state
+        _compact_state(state)
+        return
+    changed = {k: v for k, v in state.items() if prev.get(k) != v}
+    removed = [k for k in prev if k not in state]
+    _STATE = state
+    if not changed and not removed:
+        return
+    line = json.dumps({"set": changed, "del": removed}, ensure_ascii=False, separators=(",", ":"))
+    _ensure_dir(STATE_LOG.parent)
+    with STATE_LOG.open("a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    _STATE_LOG_ENTRIES += len(changed) + len(removed)
+    if _STATE_LOG_ENTRIES >= max(STATE_COMPACT_MIN, len(state)):
+        _compact_state(state)
 
 def clear_state_and_downloads():
-    try:
-        if STATE_FILE.exists():
-            STATE_FILE.unlink()
-    except Exception as e:
-        print(f"[Advarsel] Kunne ikke slette state: {e}", file=sys.stderr)
+    global _STATE, _STATE_LOG_ENTRIES
+    for p in (STATE_FILE, STATE_LOG):
+        try:
+            if p.exists():
+                p.unlink()
+        except Exception as e:
+            print(f"[Advarsel] Kunne ikke slette state: {e}", file=sys.stderr)
+    _STATE, _STATE_LOG_ENTRIES = None, 0
+    _FETCH_CACHE.clear()
+    _purge_row_index()
     try:
         if DL_DIR.exists():
             for p in DL_DIR.glob("*.csv"):
@@ -937,6 +1618,203 @@ def clear_state_and_downloads():
     except Exception as e:
         print(f"[Advarsel] Fejl ved oprydning i downloads/: {e}", file=sys.stderr)
 
+# ─────────────────────── Række-index (delta mellem polls) ───────────────────────
+ROWS_DIR = STATE_DIR / "rows"
+# Kolonner der er afledt af pipelinen og ikke indgår i rækkens fingerprint
+_DERIVED_COLS = ("group_key",) + _TYPED_COLS
+
+# Indlæst række-index for aktiv dag: key -> [fingerprint, group_key, thread_id]
+# På disk som state: snapshot (rows-<dag>.json) + append-only log (rows-<dag>.log, én
+# linje pr. poll med ændrede/slettede rækker), der komprimeres når den vokser forbi index'et.
+_ROW_INDEX: Dict[str, dict] = {}
+_ROW_LOG_ENTRIES = 0
+
+def _row_index_path(date_ymd: str) -> Path:
+    return ROWS_DIR / f"rows-{date_ymd}.json"
+
+def _row_log_path(date_ymd: str) -> Path:
+    return ROWS_DIR / f"rows-{date_ymd}.log"
+
+def _replay_row_log(date_ymd: str, rows: Dict[str, list]) -> int:
+    """Afspil dagens række-log oven på snapshot; en afkortet sidste linje skæres væk."""
+    path = _row_log_path(date_ymd)
+    if not path.exists():
+        return 0
+    n = 0
+    good = 0
+    try:
+        data = path.read_bytes()
+        for line in data.splitlines(keepends=True):
+            try:
+                rec = json.loads(line) if line.endswith(b"\n") else None
+            except Exception:
+                rec = None
+            if not isinstance(rec, dict):
+                break
+            rows.update(rec.get("set") or {})
+            for k in rec.get("del") or ():
+                rows.pop(k, None)
+            n += len(rec.get("set") or ()) + len(rec.get("del") or ())
+            good += len(line)
+        if good < len(data):
+            print(f"[Advarsel] Række-log afkortet efter {good} bytes (ufuldstændig skrivning).", file=sys.stderr)
+            with path.open("r+b") as f:
+                f.truncate(good)
+    except Exception as e:
+        print(f"[Advarsel] Kunne ikke læse række-log: {e}", file=sys.stderr)
+    return n
+
+def _compact_row_index(date_ymd: str, rows: Dict[str, list]) -> None:
+    global _ROW_LOG_ENTRIES
+    _atomic_write_json(_row_index_path(date_ymd), {"date": date_ymd, "rows": rows})
+    # Crash mellem de to trin er ufarligt: loggen indeholder absolutte værdier
+    try:
+        _row_log_path(date_ymd).unlink()
+    except FileNotFoundError:
+        pass
+    _ROW_LOG_ENTRIES = 0
+
+def _load_row_index(date_ymd: str) -> Optional[Dict[str, list]]:
+    """Række-index for dagen (None hvis der ikke findes et)."""
+    global _ROW_LOG_ENTRIES
+    if date_ymd in _ROW_INDEX:
+        return _ROW_INDEX[date_ymd]
+    p = _row_index_path(date_ymd)
+    if not p.exists():
+        return None
+    try:
+        raw = json.loads(p.read_text(encoding="utf-8"))
+        rows = raw.get("rows") if isinstance(raw, dict) else None
+        if not isinstance(rows, dict):
+            return None
+    except Exception:
+        return None
+    _ROW_LOG_ENTRIES = _replay_row_log(date_ymd, rows)
+    _ROW_INDEX.clear()
+    _ROW_INDEX[date_ymd] = rows
+    return rows
+
+def _row_keys(df: pd.DataFrame) -> pd.Series:
+    """Stabil nøgle pr. række: kanonisk obsid (dubletter får '#n'-suffiks)."""
+    oid = _map_unique(_get_series(df, "Obsid"), _canon_obsid)
+    dup = oid.duplicated(keep=False) | (oid == "")
+    if dup.any():
+        n = oid.groupby(oid).cumcount().astype(str)
+        oid = oid.where(~dup, oid + "#" + n)
+    return oid
+
+def _row_fingerprints(df: pd.DataFrame) -> pd.Series:
+    """uint64-hash af rækkens CSV-felter + kategori."""
+    cols = [c for c in df.columns if c not in _DERIVED_COLS]
+    return pd.util.hash_pandas_object(df[cols], index=False)
+
+def _thread_digests(keys: pd.Series, fps: np.ndarray, tids: np.ndarray) -> Dict[str, str]:
+    """
+    Indholds-digest pr. tråd: ordensuafhængig sum (mod 2^64) af (obsid, fingerprint)-hashes
+    for trådens rækker. Uændret digest ⇔ uændret event-sæt.
+    """
+    if len(tids) == 0:
+        return {}
+    kh = pd.util.hash_pandas_object(pd.Series(keys.to_numpy()), index=False).to_numpy()
+    with np.errstate(over="ignore"):
+        comb = fps.astype("uint64") ^ (kh * np.uint64(0x9E3779B97F4A7C15))
+    order = np.argsort(tids, kind="stable")
+    t_sorted = tids[order]
+    starts = np.flatnonzero(np.r_[True, t_sorted[1:] != t_sorted[:-1]])
+    sums = np.add.reduceat(comb[order], starts)
+    counts = np.diff(np.r_[starts, len(t_sorted)])
+    return {t: f"{int(v):016x}-{int(n)}" for t, v, n in zip(t_sorted[starts], sums, counts)}
+
+def compute_row_delta(df: pd.DataFrame, date_ymd: str) -> dict:
+    """
+    Sammenlign dagens CSV med forrige polls række-index (keyed på obsid).
+    Returnerer {inserted, modified, deleted (nøgler), groups, threads (berørte),
+    thread_digests, full (True hvis intet tidligere index)}. Index gemmes først med commit_row_delta().
+    """
+    keys = _row_keys(df)
+    fp = pd.Series(_row_fingerprints(df).to_numpy(), index=keys.to_numpy())
+    gkeys = pd.Series(_get_series(df, "group_key").to_numpy(), index=fp.index)
+    tids = pd.Series(_thread_ids(df).to_numpy(), index=fp.index)
+
+    prev = _load_row_index(date_ymd)
+    new_index = {k: [int(f), g, t] for k, f, g, t in zip(fp.index, fp.to_numpy(), gkeys.to_numpy(), tids.to_numpy())}
+    delta = {"date": date_ymd, "full": prev is None, "_index": new_index,
+             "thread_digests": _thread_digests(keys, fp.to_numpy(), tids.to_numpy())}
+    if prev is None:
+        delta.update(inserted=list(fp.index), modified=[], deleted=[],
+                     groups=set(gkeys), threads=set(tids))
+        return delta
+
+    prev_fp = pd.Series({k: v[0] for k, v in prev.items()}, dtype="uint64")
+    inserted = fp.index.difference(prev_fp.index)
+    deleted = prev_fp.index.difference(fp.index)
+    common = fp.index.intersection(prev_fp.index)
+    modified = common[fp.loc[common].to_numpy() != prev_fp.loc[common].to_numpy()]
+
+    changed = inserted.append(modified)
+    groups = set(gkeys.loc[changed]) | {prev[k][1] for k in deleted}
+    threads = set(tids.loc[changed]) | {prev[k][2] for k in deleted}
+    # modificerede rækker kan have skiftet art/lokalitet – medtag også den gamle tråd
+    for k in modified:
+        groups.add(prev[k][1]); threads.add(prev[k][2])
+    delta.update(inserted=list(inserted), modified=list(modified), deleted=list(deleted),
+                 groups=groups, threads=threads)
+    return delta
+
+def commit_row_delta(delta: Optional[dict]) -> None:
+    """
+    Gem nyt række-index – kaldes først når hele pipelinen er gennemført.
+    Kun ændrede/slettede rækker skrives (én log-linje); fuldt snapshot ved første poll og komprimering.
+    """
+    global _ROW_LOG_ENTRIES
+    if not delta:
+        return
+    date_ymd = delta["date"]
+    rows = delta["_index"]
+    _ROW_INDEX.clear()
+    _ROW_INDEX[date_ymd] = rows
+    if delta.get("full"):
+        _compact_row_index(date_ymd, rows)
+        return
+    changed = list(delta.get("inserted") or []) + list(delta.get("modified") or [])
+    deleted = list(delta.get("deleted") or [])
+    if not changed and not deleted:
+        return
+    line = json.dumps({"set": {k: rows[k] for k in changed}, "del": deleted},
+                      ensure_ascii=False, separators=(",", ":"))
+    path = _row_log_path(date_ymd)
+    _ensure_dir(path.parent)
+    with path.open("a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    _ROW_LOG_ENTRIES += len(changed) + len(deleted)
+    if _ROW_LOG_ENTRIES >= max(STATE_COMPACT_MIN, len(rows)):
+        _compact_row_index(date_ymd, rows)
+
+def _delta_summary(delta: Optional[dict]) -> str:
+    if not delta:
+        return ""
+    if delta.get("full"):
+        return f"delta=fuld ({len(delta.get('inserted') or [])} rækker)"
+    return (f"delta=+{len(delta.get('inserted') or [])} ~{len(delta.get('modified') or [])} "
+            f"-{len(delta.get('deleted') or [])} grupper={len(delta.get('groups') or ())}")
+
+def _purge_row_index(keep_date: Optional[str] = None) -> None:
+    global _ROW_LOG_ENTRIES
+    _ROW_INDEX.clear()
+    _ROW_LOG_ENTRIES = 0
+    if not ROWS_DIR.exists():
+        return
+    keep = {_row_index_path(keep_date).name, _row_log_path(keep_date).name} if keep_date else set()
+    for p in ROWS_DIR.glob("rows-*.*"):
+        if p.name in keep:
+            continue
+        try:
+            p.unlink()
+        except Exception as e:
+            print(f"[Advarsel] Kunne ikke slette række-index: {p.name} ({e})", file=sys.stderr)
+
 # ─────────────────────── Parsning/normalisering ───────────────────────
 def parse_float_str(s: str) -> str:
     return s.replace(",", ".") if s else ""
@@ -945,6 +1823,9 @@ def _current_ts_dk() -> str:
     return dt.datetime.now(DK_TZ).strftime("%Y-%m-%d %H:%M:%S %Z")
 
 def obs_timestamp_dk(row: pd.Series) -> str:
+    if "_ts_obs" in row:
+        ts = row.get("_ts_obs")
+        return "" if pd.isna(ts) else ts.strftime("%Y-%m-%d %H:%M:%S %Z")
     date_str = (row.get("Dato") or "").strip()
     time_str = (row.get("Obstidfra") or row.get("Turtidfra") or "").strip()
     if not date_str:
@@ -977,37 +1858,78 @@ def _parse_antal(val):
         return None
     return max(float(x) for x in nums)
 
+def _antal_num_series(s: pd.Series) -> pd.Series:
+    """
+    _parse_antal for en hel kolonne: de unikke værdier renses med .str-operationer,
+    tallene trækkes ud med extractall og største tal pr. værdi vælges.
+    """
+    if s.empty:
+        return pd.Series([], index=s.index, dtype="float64")
+    s = s.astype(object).fillna("").astype(str)
+    uniq = pd.Series(pd.unique(s))
+    t = (uniq.str.strip().str.lower().str.replace(",", ".", regex=False)
+         .str.replace("ca.", "", regex=False).str.replace("ca ", "", regex=False)
+         .str.replace("~", "", regex=False))
+    nums = t.str.extractall(r"(\d+(?:\.\d+)?)")
+    best = nums[0].astype("float64").groupby(level=0).max() if not nums.empty else pd.Series(dtype="float64")
+    return s.map(dict(zip(uniq, best.reindex(uniq.index)))).astype("float64")
+
+def _row_antal_num(r) -> Optional[float]:
+    """Rækkens antal som float/None (bruger '_antal_num' hvis den er beregnet)."""
+    if "_antal_num" not in r:
+        return _parse_antal(r.get("Antal", ""))
+    v = r.get("_antal_num")
+    return None if v is None or pd.isna(v) else float(v)
+
 # ─────────────────────── Region- og navne-normalisering ───────────────────────
 def _strip_accents(s: str) -> str:
     return "".join(ch for ch in unicodedata.normalize("NFKD", s) if not unicodedata.combining(ch))
 
+_SLUG_TRANSLIT = str.maketrans({"æ": "ae", "ø": "o", "å": "aa"})
+
 def _slug_region(s: str) -> str:
-    """Normaliser DOF-afdelingsnavn til slug uden diakritika (fx 'København' -> 'kobenhavn')."""
+    """
+    Normaliser DOF-afdelingsnavn/filnavnspræfiks til kanonisk slug uden diakritika
+    (fx 'DOF København' / 'københavn' -> 'kobenhavn', 'DOF Østjylland' -> 'ostjylland';
+    samme slugs som AFD_TO_REGION i web/app.js).
+    """
     s0 = (s or "").strip().lower()
     if not s0:
         return ""
-    s1 = _strip_accents(s0)
+    s0 = re.sub(r"^dof\s+", "", s0)
+    s1 = _strip_accents(s0.translate(_SLUG_TRANSLIT))
     s1 = re.sub(r"[^a-z0-9]+", "", s1)
     aliases = {
         "kbh": "kobenhavn",
-        "kobenhavn": "kobenhavn",
         "kobenhavns": "kobenhavn",
-        "bornholm": "bornholm",
-        "fyn": "fyn",
-        "nordsjaelland": "nordsjaelland",
-        "nordjylland": "nordjylland",
-        "nordvestjylland": "nordvestjylland",
-        "oestjylland": "oestjylland",
-        "sydoestjylland": "sydoestjylland",
-        "sydvestjylland": "sydvestjylland",
-        "vestjylland": "vestjylland",
-        "vestsjaelland": "vestsjaelland",
-        "storstrom": "storstrom",
-        "sonderjylland": "sonderjylland",
         "kobenhavnskommune": "kobenhavn",
+        "oestjylland": "ostjylland",
+        "sydoestjylland": "sydostjylland",
     }
     return aliases.get(s1, s1)
 
+# Alias-map: hver set DOF_afdeling-stavemåde -> kanonisk slug (udfyldes ved første opslag)
+_REGION_SLUGS: Dict[str, str] = {}
+
+def _region_slug_cached(region_raw: str) -> str:
+    slug = _REGION_SLUGS.get(region_raw)
+    if slug is None:
+        slug = _REGION_SLUGS[region_raw] = _slug_region(region_raw)
+    return slug
+
+# DOF_afdeling-værdierne som de står i DOFbasens CSV (kanonisk stavemåde)
+DOF_AFDELINGER = (
+    "DOF København", "DOF Nordsjælland", "DOF Vestsjælland", "DOF Storstrøm",
+    "DOF Bornholm", "DOF Fyn", "DOF Sønderjylland", "DOF Sydvestjylland",
+    "DOF Sydøstjylland", "DOF Vestjylland", "DOF Østjylland", "DOF Nordvestjylland",
+    "DOF Nordjylland",
+)
+_AFDELING_BY_SLUG = {_slug_region(a): a for a in DOF_AFDELINGER}
+
+def _canon_afdeling(name) -> Optional[str]:
+    """'københavn' / 'DOF Kobenhavn' / 'kbh' -> 'DOF København'; None hvis ukendt."""
+    return _AFDELING_BY_SLUG.get(_region_slug_cached(str(name)))
+
 def _norm_art(s: str) -> str:
     return re.sub(r"\s+", " ", (s or "").strip().lower())
 
@@ -1018,7 +1940,7 @@ def _read_semicolon_csv_with_fallback(path: Path) -> pd.DataFrame:
     for enc in ["utf-8", "utf-8-sig", "cp1252", "latin1"]:
         try:
             df = pd.read_csv(path, sep=";", dtype=str, keep_default_na=False, encoding=enc)
-            return df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+            return _trim_whitespace(df)
         except Exception:
             continue
     return pd.DataFrame()
@@ -1042,14 +1964,13 @@ except Exception as e:
 def load_bemaerk_thresholds() -> Dict[str, Dict[str, float]]:
     """
     Indlæs alle data/*bemaerk*.csv med kolonner 'artsnavn;bemaerk_antal'
-    og byg mapping: region_key -> { artsnavn_norm -> terskel_float }.
-    region_key er case-insensitiv men bevarer diakritik (fx 'københavn').
+    og byg én kanonisk tabel: region_slug -> { artsnavn_norm -> terskel_float }.
+    region_slug er _slug_region af filnavnets præfiks (fx 'københavn' -> 'kobenhavn').
     """
     out: Dict[str, Dict[str, float]] = {}
-    for p in DATA_DIR.glob("*bemaerk*.csv"):
+    for p in sorted(DATA_DIR.glob("*bemaerk*.csv")):
         base = p.stem  # fx 'københavn_bemaerk_parsed'
-        region_hint_raw = base.split("_")[0]  # 'københavn'
-        region_key = _region_key(region_hint_raw)  # 'københavn'
+        region_key = _slug_region(base.split("_")[0])  # 'kobenhavn'
         if not region_key:
             continue
         df = _read_semicolon_csv_with_fallback(p)
@@ -1063,18 +1984,11 @@ def load_bemaerk_thresholds() -> Dict[str, Dict[str, float]]:
                 continue
             cols["bemaerk_antal"] = possible[0]
             cols.setdefault("artsnavn", df.columns[0])
-        a_col = cols["artsnavn"]; t_col = cols["bemaerk_antal"]
-        reg_map = out.setdefault(region_key, {})
-        for _, r in df.iterrows():
-            art = _norm_art(r.get(a_col, ""))
-            if not art:
-                continue
-            v = str(r.get(t_col, "")).strip().replace(",", ".")
-            try:
-                thr = float(v)
-            except Exception:
-                continue
-            reg_map[art] = thr
+        arts = _map_unique(_str_series(df, cols["artsnavn"]), _norm_art)
+        thr = pd.to_numeric(_str_series(df, cols["bemaerk_antal"]).str.strip().str.replace(",", ".", regex=False),
+                            errors="coerce")
+        ok = (arts != "") & thr.notna()
+        out.setdefault(region_key, {}).update(zip(arts[ok], thr[ok].astype(float)))
     return out
 
 try:
@@ -1084,6 +1998,14 @@ except Exception as e:
     BEMAERK_MAP = {}
 
 # ─────────────────────── Kategorisering (hierarki) ───────────────────────
+def _bemaerk_region_key(region_raw: str) -> Optional[str]:
+    """Slug i BEMAERK_MAP for et DOF_afdeling-navn (None hvis ingen tærskler for regionen)."""
+    region_raw = (region_raw or "").strip()
+    if not region_raw:
+        return None
+    slug = _region_slug_cached(region_raw)
+    return slug if BEMAERK_MAP.get(slug) else None
+
 def art_kategori(artnavn: str, row: Optional[pd.Series] = None,
                  antal_override: Optional[float] = None, debug: bool = False) -> str:
     a_raw = (artnavn or "").strip()
@@ -1094,23 +2016,15 @@ def art_kategori(artnavn: str, row: Optional[pd.Series] = None,
         return "su"
     if a_raw in SUB_SET:
         return "sub"
-    # bemaerk: fleksibelt opslag mod BEMAERK_MAP (DOF_afdeling forbliver uændret)
+    # bemaerk: O(1)-opslag mod BEMAERK_MAP via kanonisk region-slug (DOF_afdeling forbliver uændret)
     if row is not None and BEMAERK_MAP:
         region_raw = (row.get("DOF_afdeling") or "").strip()
         if region_raw:
-            region_candidates = [region_raw, region_raw.lower()]
-            region_wo_dof = re.sub(r"^DOF\s+", "", region_raw, flags=re.IGNORECASE).strip()
-            if region_wo_dof:
-                region_candidates += [region_wo_dof, region_wo_dof.lower()]
-            reg_map = None
-            chosen_key = None
-            for key in region_candidates:
-                reg_map = BEMAERK_MAP.get(key)
-                if reg_map:
-                    chosen_key = key
-                    break
+            chosen_key = _bemaerk_region_key(region_raw)
+            reg_map = BEMAERK_MAP.get(chosen_key) if chosen_key else None
             if reg_map:
                 thr = reg_map.get(_norm_art(a_raw))
+                antal_val = None
                 if thr is not None:
                     antal_val = antal_override
                     if antal_val is None:
@@ -1120,103 +2034,513 @@ def art_kategori(artnavn: str, row: Optional[pd.Series] = None,
                 if debug:
                     print(f"[bemaerk:no] art='{a_raw}' antal={antal_val} < thr={thr} region_key='{chosen_key}'")
             elif debug:
-                print(f"[bemaerk:no] ingen region-match for '{region_raw}' (prøvede: {region_candidates})")
+                print(f"[bemaerk:no] ingen region-match for '{region_raw}' (slug='{_region_slug_cached(region_raw)}')")
     return "alm"
 
+# Opslagstabel til kolonnevis kategorisering – bygges én gang pr. (SU_SET, SUB_SET, BEMAERK_MAP)
+_KATEGORI_TABEL: dict = {"key": None, "thr": None}
+
+def _kategori_tabel() -> pd.Series:
+    """
+    Returnér tærskel-tabel: MultiIndex (region_slug, art_norm) -> bemaerk-tærskel.
+    Genbygges kun når BEMAERK_MAP (eller SU/SUB-sættene) er blevet udskiftet.
+    """
+    key = (id(SU_SET), id(SUB_SET), id(BEMAERK_MAP))
+    if _KATEGORI_TABEL["key"] != key:
+        regs, arts, thrs = [], [], []
+        for reg_key, reg_map in (BEMAERK_MAP or {}).items():
+            for art, thr in (reg_map or {}).items():
+                regs.append(reg_key); arts.append(art); thrs.append(float(thr))
+        idx = pd.MultiIndex.from_arrays([regs, arts], names=["region_slug", "art_norm"])
+        thr_s = pd.Series(thrs, index=idx, dtype="float64")
+        _KATEGORI_TABEL.update(key=key, thr=thr_s[~thr_s.index.duplicated(keep="last")])
+    return _KATEGORI_TABEL["thr"]
+
+def art_kategori_frame(df: pd.DataFrame, antal_num: Optional[pd.Series] = None) -> pd.Series:
+    """
+    Kolonnevis udgave af art_kategori: giver 'kategori' for alle rækker i df
+    via opslag i SU/SUB-sæt og join mod bemaerk-tabellen (samme hierarki).
+    """
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    art = _str_series(df, "Artnavn").str.strip()
+    out = pd.Series("alm", index=df.index, dtype=object)
+
+    is_su = art.isin(SU_SET)
+    is_sub = ~is_su & art.isin(SUB_SET)
+    out[is_su] = "su"
+    out[is_sub] = "sub"
+
+    rest = (art != "") & ~is_su & ~is_sub
+    if BEMAERK_MAP and "DOF_afdeling" in df.columns and rest.any():
+        thr_tab = _kategori_tabel()
+        region_key = _map_unique(df.loc[rest, "DOF_afdeling"], _bemaerk_region_key)
+        art_norm = _map_unique(art[rest], _norm_art)
+        mi = pd.MultiIndex.from_arrays([region_key.fillna(""), art_norm])
+        thr = thr_tab.reindex(mi).to_numpy()
+        if antal_num is None:
+            antal_num = _antal_num_series(_get_series(df, "Antal"))
+        antal = pd.to_numeric(antal_num[rest], errors="coerce").to_numpy(dtype="float64")
+        is_bem = pd.Series(False, index=df.index)
+        with np.errstate(invalid="ignore"):
+            is_bem[rest] = antal >= thr  # NaN (ingen tærskel/antal) giver False
+        out[is_bem] = "bemaerk"
+    return out
+
 # ─────────────────────── Filtrering (regler) ───────────────────────
-def load_clients_config(path: Optional[str]) -> List[dict]:
+_DEFAULT_CLIENTS = [{"id": "default", "sinks": [{"type": "stdout"}], "rules": {}}]
+COMPILED_VERSION = 1  # bump når compile_rules/prædikat-formatet ændres
+
+def load_clients_config(path: Optional[str], use_cache: bool = True) -> List[dict]:
+    """
+    Indlæs, validér og kompilér klient-config. Den kompilerede form gemmes i
+    state/<navn>.compiled.json nøglet på YAML-filens sha256 og genbruges ved
+    genstart, så længe filen er uændret (se compile-config).
+    """
     if not path:
-        return [{"id": "default", "sinks": [{"type": "stdout"}], "rules": {}}]
+        return compile_client_rules([dict(c) for c in _DEFAULT_CLIENTS])
     p = Path(path)
     if not p.exists():
         raise SystemExit(f"Client-config ikke fundet: {p}")
-    with p.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
-    clients = data.get("clients", [])
+    raw = p.read_bytes()
+    sha = hashlib.sha256(raw).hexdigest()
+    if use_cache:
+        cached = _load_compiled_config(p, sha)
+        if cached is not None:
+            return cached
+    data = yaml.safe_load(raw.decode("utf-8")) or {}
+    clients = data.get("clients", []) if isinstance(data, dict) else None
+    if clients is None or not isinstance(clients, list):
+        raise SystemExit(f"Ugyldig client-config {p}: 'clients' skal være en liste")
     if not clients:
-        clients = [{"id": "default", "sinks": [{"type": "stdout"}], "rules": {}}]
+        clients = [dict(c) for c in _DEFAULT_CLIENTS]
+    errors, warns = validate_clients(clients)
+    for w in warns:
+        print(f"[Advarsel] {p.name}: {w}", file=sys.stderr)
+    if errors:
+        raise SystemExit(f"Ugyldig client-config {p} ({len(errors)} fejl):\n  " + "\n  ".join(errors))
+    clients = compile_client_rules(clients)
+    _save_compiled_config(p, sha, clients)
     return clients
 
-def build_mask(df: pd.DataFrame, rules: dict) -> pd.Series:
-    """
-    Understøttede regler:
-    species, exclude_species,
-    adf_contains, loknavn_contains, (kompat) adf_regex/loknavn_regex -> literal substring
-    loknr, dof_afdelinger,
-    time_range {from,to}, min_antal,
-    only_with_coords, bbox [lon_min, lat_min, lon_max, lat_max],
-    kategori ["alm","sub","su","bemaerk"]
-    """
-    m = pd.Series(True, index=df.index)
+# ─── Validering ───
+# Samme regelnøgler som build_mask; ukendte nøgler er fejl (en stavefejl ville
+# ellers stille og roligt matche alt).
+_RULE_LIST_KEYS = ("species", "exclude_species", "loknr", "dof_afdelinger", "kategori")
+_RULE_TEXT_KEYS = ("adf_contains", "adf_regex", "loknavn_contains", "loknavn_regex")
+_RULE_KEYS = set(_RULE_LIST_KEYS + _RULE_TEXT_KEYS + ("time_range", "min_antal", "only_with_coords", "bbox"))
+_KATEGORIER = ("alm", "sub", "su", "bemaerk")
+_SINK_TYPES = ("stdout", "file", "webpush")
 
-    # 1) Arter
-    species = rules.get("species")
-    if species:
-        m &= df["Artnavn"].isin(species)
-    ex = rules.get("exclude_species")
-    if ex:
-        m &= ~df["Artnavn"].isin(ex)
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
 
-    # 2) Adfærd / Loknavn (literal substring, case-insensitive)
+def _validate_rules(rules, where: str, errors: List[str], warns: List[str]) -> None:
+    if rules is None:
+        return
+    if not isinstance(rules, dict):
+        errors.append(f"{where}: 'rules' skal være et map, ikke {type(rules).__name__}")
+        return
+    for k in rules:
+        if k not in _RULE_KEYS:
+            hint = difflib.get_close_matches(str(k), sorted(_RULE_KEYS), n=1)
+            errors.append(f"{where}: ukendt regel '{k}'" + (f" (mente du '{hint[0]}'?)" if hint else ""))
+
+    for k in _RULE_LIST_KEYS:
+        if k not in rules:
+            continue
+        v = rules[k]
+        vals = v if isinstance(v, list) else [v]
+        if v is None or not vals:
+            warns.append(f"{where}: '{k}' er tom og ignoreres")
+            continue
+        bad = [x for x in vals if not isinstance(x, (str, int)) or isinstance(x, bool)]
+        if bad:
+            errors.append(f"{where}: '{k}' skal være tekst eller liste af tekst: {bad!r}")
+            continue
+        if k == "kategori":
+            unknown = [x for x in vals if str(x).strip().lower() not in _KATEGORIER]
+            if unknown:
+                errors.append(f"{where}: ukendt kategori {unknown!r} (gyldige: {', '.join(_KATEGORIER)})")
+        elif k == "dof_afdelinger":
+            for x in vals:
+                canon = _canon_afdeling(x)
+                if canon is None:
+                    warns.append(f"{where}: ukendt DOF-afdeling '{x}' matcher aldrig")
+                elif canon != x:
+                    warns.append(f"{where}: afdeling '{x}' normaliseres til '{canon}'")
+
+    for k in _RULE_TEXT_KEYS:
+        if k in rules and not isinstance(rules[k], (str, int)):
+            errors.append(f"{where}: '{k}' skal være tekst")
+    for lit, alt in (("adf_contains", "adf_regex"), ("loknavn_contains", "loknavn_regex")):
+        if rules.get(lit) and rules.get(alt):
+            warns.append(f"{where}: både '{lit}' og '{alt}' – kun '{lit}' bruges")
+        if isinstance(rules.get(alt), str) and re.search(r"[\\^$.|?*+()\[\]{}]", rules[alt]):
+            warns.append(f"{where}: '{alt}' matches som literal tekst, ikke regex: {rules[alt]!r}")
+
+    if "time_range" in rules:
+        tr = rules["time_range"]
+        if not isinstance(tr, dict):
+            errors.append(f"{where}: 'time_range' skal være et map med from/to")
+        else:
+            for k in tr:
+                if k not in ("from", "to"):
+                    errors.append(f"{where}: ukendt nøgle 'time_range.{k}' (gyldige: from, to)")
+            for k in ("from", "to"):
+                if tr.get(k) and _rule_minutes(tr[k]) is None:
+                    errors.append(f"{where}: ulæseligt tidspunkt time_range.{k}={tr[k]!r} (brug \"HH:MM\")")
+            lo, hi = _rule_minutes(tr.get("from") or ""), _rule_minutes(tr.get("to") or "")
+            if lo is not None and hi is not None and lo > hi:
+                warns.append(f"{where}: time_range.from > time_range.to matcher aldrig")
+
+    if rules.get("min_antal") is not None:
+        try:
+            float(rules["min_antal"])
+        except (TypeError, ValueError):
+            errors.append(f"{where}: 'min_antal' skal være et tal, ikke {rules['min_antal']!r}")
+    if "only_with_coords" in rules and not isinstance(rules["only_with_coords"], bool):
+        errors.append(f"{where}: 'only_with_coords' skal være true/false")
+
+    if rules.get("bbox") is not None:
+        b = rules["bbox"]
+        if not isinstance(b, list) or len(b) != 4 or not all(_is_number(x) for x in b):
+            errors.append(f"{where}: 'bbox' skal være [lon_min, lat_min, lon_max, lat_max] (tal)")
+        elif b[0] > b[2] or b[1] > b[3]:
+            errors.append(f"{where}: 'bbox' har min > max: {b!r}")
+
+def validate_clients(clients: List[dict]) -> tuple[List[str], List[str]]:
+    """Validér klient-liste (id'er, sinks, regler). Returnerer (fejl, advarsler)."""
+    errors: List[str] = []
+    warns: List[str] = []
+    seen: Set[str] = set()
+    for i, c in enumerate(clients):
+        if not isinstance(c, dict):
+            errors.append(f"clients[{i}]: skal være et map")
+            continue
+        cid = c.get("id")
+        where = f"klient '{cid}'" if cid else f"clients[{i}]"
+        if not cid:
+            errors.append(f"{where}: mangler 'id'")
+        elif str(cid) in seen:
+            errors.append(f"{where}: id er brugt flere gange")
+        else:
+            seen.add(str(cid))
+        sinks = c.get("sinks", [])
+        if not isinstance(sinks, list):
+            errors.append(f"{where}: 'sinks' skal være en liste")
+        else:
+            for s in sinks:
+                # Samme standarder som fanout: uden 'type' skrives til både stdout og fil,
+                # webpush uden 'url' poster til den lokale server
+                if isinstance(s, dict) and "type" not in s:
+                    warns.append(f"{where}: sink {s!r} uden 'type' – skrives til både stdout og fil")
+                    continue
+                stype = str(s.get("type") or "").lower() if isinstance(s, dict) else ""
+                if stype not in _SINK_TYPES:
+                    errors.append(f"{where}: ukendt sink {s!r} (gyldige typer: {', '.join(_SINK_TYPES)})")
+                elif stype == "webpush" and not s.get("url"):
+                    warns.append(f"{where}: webpush-sink uden 'url' – bruger http://localhost:8000/api/publish")
+        _validate_rules(c.get("rules"), where, errors, warns)
+    return errors, warns
+
+# ─── Kompileret config-cache ───
+def _compiled_config_path(config_path: Path) -> Path:
+    return STATE_DIR / f"{config_path.stem}.compiled.json"
+
+def _tuplify(v):
+    return tuple(_tuplify(x) for x in v) if isinstance(v, list) else v
+
+def _load_compiled_config(config_path: Path, sha: str) -> Optional[List[dict]]:
+    try:
+        with _compiled_config_path(config_path).open("r", encoding="utf-8") as f:
+            art = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(art, dict) or art.get("version") != COMPILED_VERSION or art.get("sha256") != sha:
+        return None
+    clients = art.get("clients") or []
+    for c in clients:
+        c["_preds"] = _tuplify(c.get("_preds") or [])
+    return clients
+
+def _save_compiled_config(config_path: Path, sha: str, clients: List[dict]) -> Optional[Path]:
+    out = _compiled_config_path(config_path)
+    art = {"version": COMPILED_VERSION, "source": str(config_path), "sha256": sha,
+           "compiled_at": dt.datetime.now(DK_TZ).isoformat(timespec="seconds"), "clients": clients}
+    try:
+        _ensure_dir(out.parent)
+        _atomic_write_json(out, art)
+        return out
+    except (OSError, TypeError, ValueError) as e:
+        print(f"[Advarsel] Kunne ikke gemme kompileret config {out}: {e}", file=sys.stderr)
+        return None
+
+def _pred_label(p: tuple) -> str:
+    kind = p[0]
+    if kind in ("isin", "notin", "isin_opt"):
+        vals = [str(v) for v in p[2]]
+        shown = ", ".join(vals[:3]) + (f", … (+{len(vals) - 3})" if len(vals) > 3 else "")
+        return f"{p[1]} {'∉' if kind == 'notin' else '∈'} {{{shown}}}"
+    if kind == "contains":
+        return f"{p[1]} ~ {p[2]!r}"
+    if kind in ("time_from", "time_to"):
+        m = int(p[1] or 0)
+        return f"tid {'≥' if kind == 'time_from' else '≤'} {m // 60:02d}:{m % 60:02d}"
+    if kind == "min_antal":
+        return f"antal ≥ {p[1]:g}"
+    if kind == "coords":
+        return "har koordinater"
+    if kind == "bbox":
+        return "bbox [" + ", ".join(f"{x:g}" for x in p[1]) + "]"
+    if kind == "kategori":
+        return "kategori ∈ {" + ", ".join(p[1]) + "}"
+    return repr(p)
+
+def compile_config_report(config_path: str) -> int:
+    """
+    compile-config: validér, normalisér og kompilér config'en (uden cache),
+    gem den kompilerede form og rapportér pr. klient hvilke prædikater der deles.
+    """
+    t0 = time.perf_counter()
+    clients = load_clients_config(config_path, use_cache=False)
+    ms = (time.perf_counter() - t0) * 1000
+    preds_all, _, generic = _dispatch_index(clients)
+    shared: Dict[tuple, int] = {}
+    for preds in preds_all:
+        for pr in preds:
+            shared[pr] = shared.get(pr, 0) + 1
+    generic_set = set(generic)
+    for i, (c, preds) in enumerate(zip(clients, preds_all)):
+        parts = [_pred_label(pr) + (f" (delt ×{shared[pr]})" if shared[pr] > 1 else " (unik)")
+                 for pr in preds] or ["(ingen regler – matcher alt)"]
+        mode = "maske" if i in generic_set else "dispatch"
+        print(f"  {c.get('id')} [{mode}]: " + "; ".join(parts))
+    n_shared = sum(1 for n in shared.values() if n > 1)
+    out = _compiled_config_path(Path(config_path))
+    print(f"[compile-config] {config_path}: {len(clients)} klienter, {len(shared)} unikke prædikater "
+          f"({n_shared} delt), {len(clients) - len(generic)} via dispatch-index – skrevet {out} ({ms:.1f} ms)")
+    return 0
+
+# ─── Regel-kompilering ───
+# En klients regler oversættes én gang (ved config-load) til en tuple af hashbare
+# prædikater. Identiske prædikater deles på tværs af klienter og evalueres kun én
+# gang pr. poll som bitmaske; klientens maske er AND af dens prædikat-masker.
+
+def _rule_values(v) -> tuple:
+    vals = v if isinstance(v, (list, tuple, set)) else [v]
+    return tuple(sorted(set(vals), key=str))
+
+def compile_rules(rules: dict) -> tuple:
+    """Oversæt regler (se build_mask) til en sorteret tuple af prædikater."""
+    rules = rules or {}
+    preds = []
+    if rules.get("species"):
+        preds.append(("isin", "Artnavn", _rule_values(rules["species"])))
+    if rules.get("exclude_species"):
+        preds.append(("notin", "Artnavn", _rule_values(rules["exclude_species"])))
     adf_lit = rules.get("adf_contains") or rules.get("adf_regex")
     if adf_lit:
-        m &= df["Adfbeskrivelse"].str.contains(str(adf_lit), case=False, na=False, regex=False)
+        preds.append(("contains", "Adfbeskrivelse", str(adf_lit)))
     lok_lit = rules.get("loknavn_contains") or rules.get("loknavn_regex")
     if lok_lit:
-        m &= df["Loknavn"].str.contains(str(lok_lit), case=False, na=False, regex=False)
-
-    # 3) Lokation
-    loknr = rules.get("loknr")
-    if loknr:
-        m &= df["Loknr"].isin(loknr)
-    dof = rules.get("dof_afdelinger")
-    if dof and "DOF_afdeling" in df.columns:
-        m &= df["DOF_afdeling"].isin(dof)
-
-    # 4) Tid
+        preds.append(("contains", "Loknavn", str(lok_lit)))
+    if rules.get("loknr"):
+        preds.append(("isin", "Loknr", _rule_values(rules["loknr"])))
+    if rules.get("dof_afdelinger"):
+        afd = _rule_values(rules["dof_afdelinger"])
+        preds.append(("isin_opt", "DOF_afdeling", _rule_values([_canon_afdeling(a) or a for a in afd])))
     tr = rules.get("time_range")
-    if tr and (tr.get("from") or tr.get("to")):
-        t_from_series = df["Obstidfra"].fillna("").str.strip()
-        have_time = t_from_series.str.len() >= 4
-        if tr.get("from"):
-            m &= have_time & (t_from_series >= tr["from"])
-        if tr.get("to"):
-            m &= have_time & (t_from_series <= tr["to"])
-
-    # 5) Antal
-    min_a = rules.get("min_antal")
-    if (min_a is not None) and ("Antal" in df.columns):
-        antal = pd.to_numeric(df["Antal"], errors="coerce").fillna(0)
-        m &= antal >= float(min_a)
-
-    # 6) Koordinater / BBox
+    if tr and tr.get("from"):
+        preds.append(("time_from", _rule_minutes(tr["from"])))
+    if tr and tr.get("to"):
+        preds.append(("time_to", _rule_minutes(tr["to"])))
+    if rules.get("min_antal") is not None:
+        preds.append(("min_antal", float(rules["min_antal"])))
     if rules.get("only_with_coords"):
-        # FIX: OR/AND-logik (obs OR lok) pr. akse, derefter AND mellem akser
-        has_lon = df["obs_laengdegrad"].ne("") | df["lok_laengdegrad"].ne("")
-        has_lat = df["obs_breddegrad"].ne("") | df["lok_breddegrad"].ne("")
-        m &= has_lon & has_lat
-    bbox = rules.get("bbox")
-    if bbox:
-        lon_min, lat_min, lon_max, lat_max = bbox
-        lon = df["obs_laengdegrad"].replace("", pd.NA).fillna(df["lok_laengdegrad"])
-        lat = df["obs_breddegrad"].replace("", pd.NA).fillna(df["lok_breddegrad"])
-        lon = pd.to_numeric(lon.astype(str).str.replace(",", "."), errors="coerce")
-        lat = pd.to_numeric(lat.astype(str).str.replace(",", "."), errors="coerce")
-        m &= (lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max)
-
-    # 7) Kategori
+        preds.append(("coords",))
+    if rules.get("bbox"):
+        preds.append(("bbox", tuple(float(x) for x in rules["bbox"])))
     cats = rules.get("kategori")
     if cats:
         if isinstance(cats, str):
             cats = [cats]
-        cats_norm = {str(c).strip().lower() for c in cats if str(c).strip()}
-        s_cat = df["kategori"] if "kategori" in df.columns else (
-            df.apply(lambda r: art_kategori(r.get("Artnavn",""), r), axis=1)
-        )
-        m &= s_cat.isin(cats_norm)
+        cats_norm = tuple(sorted({str(c).strip().lower() for c in cats if str(c).strip()}))
+        preds.append(("kategori", cats_norm))
+    return tuple(sorted(preds, key=repr))
 
+def compile_client_rules(clients: List[dict]) -> List[dict]:
+    """Kompilér 'rules' for alle klienter (gemmes i c['_preds'])."""
+    for c in clients:
+        c["_preds"] = compile_rules(c.get("rules", {}) or {})
+    return clients
+
+def _predicate_mask(df: pd.DataFrame, pred: tuple) -> np.ndarray:
+    kind = pred[0]
+    if kind == "isin":
+        return df[pred[1]].isin(pred[2]).to_numpy(bool)
+    if kind == "notin":
+        return ~df[pred[1]].isin(pred[2]).to_numpy(bool)
+    if kind == "isin_opt":
+        if pred[1] not in df.columns:
+            return np.ones(len(df), dtype=bool)
+        return df[pred[1]].isin(pred[2]).to_numpy(bool)
+    if kind == "contains":
+        return df[pred[1]].str.contains(pred[2], case=False, na=False, regex=False).to_numpy(bool)
+    if kind in ("time_from", "time_to"):
+        t_min = df["_tid_min"] if "_tid_min" in df.columns else \
+            _map_unique(_get_series(df, "Obstidfra"), _time_minutes).astype("float64")
+        t = t_min.to_numpy("float64")
+        if pred[1] is None:  # ulæselig regel-tid matcher intet (som pandas' sammenligning med None)
+            return np.zeros(len(df), dtype=bool)
+        # NaN (ingen tid) sammenligner False
+        return (t >= pred[1]) if kind == "time_from" else (t <= pred[1])
+    if kind == "min_antal":
+        if "Antal" not in df.columns:
+            return np.ones(len(df), dtype=bool)
+        antal = df["_antal_num"] if "_antal_num" in df.columns else _antal_num_series(df["Antal"])
+        return (antal.fillna(0) >= pred[1]).to_numpy(bool)
+    if kind == "coords":
+        # Læsbar lon OG lat (obs, ellers lokalitetens)
+        lon, lat = _lonlat_arrays(df)
+        return ~np.isnan(lon) & ~np.isnan(lat)
+    if kind == "bbox":
+        return _bbox_masks(df, [pred[1]])[0]
+    if kind == "kategori":
+        s_cat = df["kategori"] if "kategori" in df.columns else art_kategori_frame(df)
+        return s_cat.isin(pred[1]).to_numpy(bool)
+    raise ValueError(f"Ukendt prædikat: {kind}")
+
+def _lonlat_arrays(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    if "_lon" in df.columns and "_lat" in df.columns:
+        return df["_lon"].to_numpy("float32"), df["_lat"].to_numpy("float32")
+    return (_coord_series(df, "obs_laengdegrad", "lok_laengdegrad").to_numpy("float32"),
+            _coord_series(df, "obs_breddegrad", "lok_breddegrad").to_numpy("float32"))
+
+def _bbox_masks(df: pd.DataFrame, boxes: List[tuple]) -> np.ndarray:
+    """
+    Masker (len(boxes) × len(df)) for bbox'e [lon_min, lat_min, lon_max, lat_max]
+    i én broadcast over float32-koordinaterne (grænser castes også til float32).
+    """
+    lon, lat = _lonlat_arrays(df)
+    b = np.asarray(boxes, dtype="float32").reshape(-1, 4)
+    with np.errstate(invalid="ignore"):
+        return ((lon[None, :] >= b[:, 0:1]) & (lon[None, :] <= b[:, 2:3]) &
+                (lat[None, :] >= b[:, 1:2]) & (lat[None, :] <= b[:, 3:4]))
+
+def _prefill_bbox_masks(df: pd.DataFrame, preds_list, cache: dict) -> None:
+    """Evaluér alle unikke bbox-prædikater for mange klienter i én broadcast og læg dem i 'cache'."""
+    boxes = list(dict.fromkeys(p for preds in preds_list for p in preds if p[0] == "bbox" and p not in cache))
+    if len(boxes) < 2:
+        return
+    for p, m in zip(boxes, _bbox_masks(df, [p[1] for p in boxes])):
+        cache[p] = m
+
+def _combined_mask(df: pd.DataFrame, preds: tuple, cache: dict) -> np.ndarray:
+    """AND af prædikat-masker; både prædikater og hele kombinationer caches i 'cache'."""
+    m = cache.get(preds)
+    if m is not None:
+        return m
+    m = np.ones(len(df), dtype=bool)
+    for p in preds:
+        pm = cache.get(p)
+        if pm is None:
+            pm = cache[p] = _predicate_mask(df, p)
+        m = m & pm
+    cache[preds] = m
     return m
 
+# Dispatch-index for rene (DOF_afdeling × kategori)-profiler, cachet på klienternes prædikater
+_DISPATCH_CACHE: Dict[tuple, tuple] = {}
+_DISPATCH_KINDS = {"isin_opt", "kategori"}
+_ANY = "*"
+
+def _dispatch_index(clients: List[dict]) -> tuple:
+    """
+    Returnér (prædikater pr. klient, index, generic):
+      index: (afdeling|'*', kategori|'*') -> [klient-positioner]  (rene region/kategori-profiler)
+      generic: [klient-positioner] der kræver fuld maske-evaluering (bbox, time_range, species …)
+    """
+    preds_all = tuple(c.get("_preds") if c.get("_preds") is not None else compile_rules(c.get("rules", {}) or {})
+                      for c in clients)
+    hit = _DISPATCH_CACHE.get(preds_all)
+    if hit is not None:
+        return hit
+    index: Dict[tuple, List[int]] = {}
+    generic: List[int] = []
+    for i, preds in enumerate(preds_all):
+        if any(p[0] not in _DISPATCH_KINDS for p in preds):
+            generic.append(i)
+            continue
+        regs: tuple = (_ANY,)
+        cats: tuple = (_ANY,)
+        for p in preds:
+            if p[0] == "isin_opt":
+                regs = p[2]
+            else:
+                cats = p[1]
+        for a in regs:
+            for k in cats:
+                index.setdefault((a, k), []).append(i)
+    _DISPATCH_CACHE.clear()
+    _DISPATCH_CACHE[preds_all] = (preds_all, index, generic)
+    return _DISPATCH_CACHE[preds_all]
+
+def client_rows(df: pd.DataFrame, clients: List[dict]) -> List[np.ndarray]:
+    """
+    Positionelle rækkeindeks (stigende) pr. klient.
+    Rækkerne grupperes én gang på (DOF_afdeling, kategori) og routes via dispatch-indexet;
+    kun profiler med rigere regler evalueres med prædikat-masker (fælles prædikater én gang).
+    """
+    preds_all, index, generic = _dispatch_index(clients)
+    n = len(df)
+    if "DOF_afdeling" not in df.columns or "kategori" not in df.columns:
+        generic = list(range(len(clients)))
+        index = {}
+
+    hits: List[List[np.ndarray]] = [[] for _ in clients]
+    if index and n:
+        a_codes, a_uni = pd.factorize(df["DOF_afdeling"])  # NaN -> -1
+        k_codes, k_uni = pd.factorize(df["kategori"])
+        combo = (a_codes + 1) * (len(k_uni) + 1) + (k_codes + 1)
+        order = np.argsort(combo, kind="stable")
+        uniq, starts = np.unique(combo[order], return_index=True)
+        bounds = list(starts[1:]) + [n]
+        for code, lo, hi in zip(uniq, starts, bounds):
+            ac, kc = divmod(int(code), len(k_uni) + 1)
+            a = a_uni[ac - 1] if ac else None
+            k = k_uni[kc - 1] if kc else None
+            targets = set(index.get((_ANY, _ANY), ()))
+            if a is not None:
+                targets.update(index.get((a, _ANY), ()))
+            if k is not None:
+                targets.update(index.get((_ANY, k), ()))
+            if a is not None and k is not None:
+                targets.update(index.get((a, k), ()))
+            if targets:
+                pos = order[lo:hi]
+                for i in targets:
+                    hits[i].append(pos)
+
+    out: List[np.ndarray] = [np.sort(np.concatenate(h)) if h else np.empty(0, dtype=np.intp) for h in hits]
+    cache: dict = {}
+    _prefill_bbox_masks(df, (preds_all[i] for i in generic), cache)
+    for i in generic:
+        out[i] = np.flatnonzero(_combined_mask(df, preds_all[i], cache))
+    return out
+
+def build_mask(df: pd.DataFrame, rules: dict) -> pd.Series:
+    """
+    Understøttede regler:
+    species, exclude_species,
+    adf_contains, loknavn_contains, (kompat) adf_regex/loknavn_regex -> literal substring
+    loknr, dof_afdelinger,
+    time_range {from,to}, min_antal,
+    only_with_coords, bbox [lon_min, lat_min, lon_max, lat_max],
+    kategori ["alm","sub","su","bemaerk"]
+    """
+    return pd.Series(_combined_mask(df, compile_rules(rules), {}), index=df.index)
+
 # ─────────────────────── CLI-rendering ───────────────────────
 def render_output_line(r: pd.Series, timestamp_mode: str, kategori: str) -> str:
     ts = obs_timestamp_dk(r) if timestamp_mode == "obs" else _current_ts_dk()
@@ -1238,57 +2562,271 @@ def render_output_line(r: pd.Series, timestamp_mode: str, kategori: str) -> str:
     parts = [ts, f"[{kategori}]", antal_art, adf, lok, dof_afd, name, coords, t_span]
     return " · ".join([p for p in parts if p])
 
+def _render_record(r: pd.Series, timestamp_mode: str) -> MappingProxyType:
+    """
+    Materialisér én ny række til en frosset record, som deles af alle klienter/sinks:
+      line  – CLI-linje (uden klient-præfiks)
+      feed  – feed.jsonl-felter som JSON-hale (efter "client"/"generated")
+      item, item_json – batch-item og dets serialisering (indent=0)
+      afd, cat, head – afdeling, kategori og teaser-tekst til webpush
+    """
+    cat = r.get("kategori") or art_kategori(r.get("Artnavn", ""), r)
+    afd = (r.get("DOF_afdeling", "") or "").strip()
+    lon = r.get("obs_laengdegrad") or r.get("lok_laengdegrad", "")
+    lat = r.get("obs_breddegrad") or r.get("lok_breddegrad", "")
+    feed = {
+        "obsid": r.get("Obsid",""),
+        "art": r.get("Artnavn",""),
+        "antal": r.get("Antal",""),
+        "adf": r.get("Adfbeskrivelse",""),
+        "lok": r.get("Loknavn",""),
+        "dof_afdeling": r.get("DOF_afdeling",""),
+        "fornavn": r.get("Fornavn",""),
+        "efternavn": r.get("Efternavn",""),
+        "lon": lon,
+        "lat": lat,
+        "tid_fra": r.get("Obstidfra",""),
+        "tid_til": r.get("Obstidtil",""),
+        "kategori": cat,
+    }
+    item = {
+        "obsid": r.get("Obsid",""),
+        "loknr": r.get("Loknr",""),          # ← NYT: send loknr med
+        "art": r.get("Artnavn",""),
+        "antal": r.get("Antal",""),
+        "adf": r.get("Adfbeskrivelse",""),
+        "lok": r.get("Loknavn",""),
+        "dof_afdeling": afd,
+        "fornavn": r.get("Fornavn",""),
+        "efternavn": r.get("Efternavn",""),
+        "lon": lon,
+        "lat": lat,
+        "tid_fra": r.get("Obstidfra",""),
+        "tid_til": r.get("Obstidtil",""),
+        "kategori": cat
+    }
+    return MappingProxyType({
+        "line": render_output_line(r, timestamp_mode, cat),
+        "feed": json.dumps(feed, ensure_ascii=False)[1:],  # '"obsid": …}' – splejses efter client/generated
+        "item": item,
+        "item_json": json.dumps(item, ensure_ascii=False, indent=0),
+        "afd": afd,
+        "cat": cat,
+        "head": f"{r.get('Antal','')} {r.get('Artnavn','')}".strip(),
+    })
+
+def _render_records(df: pd.DataFrame, routed: List[np.ndarray], timestamp_mode: str) -> Dict[int, MappingProxyType]:
+    """Render hver række, der routes til mindst én klient, præcis én gang (position -> record)."""
+    if not routed:
+        return {}
+    used = np.unique(np.concatenate(routed))
+    return {int(i): _render_record(df.iloc[int(i)], timestamp_mode) for i in used}
+
+# ─────────────────────── Outbox (collector → server publish) ───────────────────────
+# Publish-kald lægges i en begrænset, diskbaseret outbox (state/outbox/*.json) og
+# sendes af en baggrundstråd over én langlivet, poolet session med retry/backoff.
+# Polls blokerer derfor ikke på push-serveren; uafsendte kald overlever genstart.
+OUTBOX_DIR = STATE_DIR / "outbox"
+OUTBOX_BAD_DIR = OUTBOX_DIR / "bad"  # ugyldige poster flyttes hertil (til fejlsøgning) i stedet for at blive sendt
+OUTBOX_MAX_ITEMS = 1000      # ældste kald droppes, hvis serveren er nede længe
+OUTBOX_WORKERS = 4           # samtidige POSTs (og størrelse på connection-pool)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_MAX = 300.0   # sek.
+
+_HTTP_SESSION: Optional[requests.Session] = None
+_OUTBOX_LOCK = threading.Lock()
+_OUTBOX_WAKE = threading.Event()
+_OUTBOX_INFLIGHT: Set[str] = set()
+_OUTBOX_POOL: Optional[ThreadPoolExecutor] = None
+_OUTBOX_THREAD: Optional[threading.Thread] = None
+_OUTBOX_SEQ = 0
+
+def _http_session() -> requests.Session:
+    global _HTTP_SESSION
+    with _OUTBOX_LOCK:
+        if _HTTP_SESSION is None:
+            sess = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=OUTBOX_WORKERS,
+                                                    pool_maxsize=OUTBOX_WORKERS)
+            sess.mount("http://", adapter); sess.mount("https://", adapter)
+            _HTTP_SESSION = sess
+        return _HTTP_SESSION
+
+def _outbox_files() -> List[Path]:
+    if not OUTBOX_DIR.exists():
+        return []
+    return sorted(OUTBOX_DIR.glob("*.json"))  # filnavne er tids-/sekvensordnede (FIFO)
+
+def outbox_put(url: str, payload, timeout=(3.05, 30.0)) -> None:
+    """Læg et publish-kald i outboxen og væk afsenderen (blokerer ikke på serveren)."""
+    global _OUTBOX_SEQ
+    with _OUTBOX_LOCK:
+        _OUTBOX_SEQ += 1
+        name = f"{time.time_ns():020d}-{os.getpid()}-{_OUTBOX_SEQ:06d}.json"
+    files = _outbox_files()
+    for p in files[:max(0, len(files) - OUTBOX_MAX_ITEMS + 1)]:
+        if p.name in _OUTBOX_INFLIGHT:
+            continue
+        try:
+            p.unlink()
+            print(f"[outbox] Fuld ({OUTBOX_MAX_ITEMS}) – dropper ældste: {p.name}", file=sys.stderr)
+        except Exception:
+            pass
+    _atomic_write_json(OUTBOX_DIR / name, {
+        "url": url, "payload": payload, "timeout": list(timeout),
+        "attempts": 0, "next_try": 0.0,
+    })
+    _outbox_start()
+    _OUTBOX_WAKE.set()
+
+def _outbox_quarantine(path: Path, why: str) -> None:
+    print(f"[outbox] {why} – flyttes til {OUTBOX_BAD_DIR.name}/: {path.name}", file=sys.stderr)
+    try:
+        _ensure_dir(OUTBOX_BAD_DIR)
+        os.replace(path, OUTBOX_BAD_DIR / path.name)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        path.unlink(missing_ok=True)
+
+def _outbox_send(path: Path) -> None:
+    try:
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except Exception:
+            _outbox_quarantine(path, "Ulæselig post")
+            return
+        if not isinstance(entry, dict) or not isinstance(entry.get("url"), str):
+            _outbox_quarantine(path, "Ugyldig post")
+            return
+        url = entry.get("url")
+        err = None
+        try:
+            resp = _http_session().post(url, json=entry.get("payload"), timeout=tuple(entry.get("timeout") or (3.05, 30.0)))
+            code = getattr(resp, "status_code", 200)
+            if code < 400:
+                path.unlink(missing_ok=True)
+                return
+            if 400 <= code < 500 and code not in (408, 429):
+                print(f"[webpush] POST {url} afvist ({code}) – droppes", file=sys.stderr)
+                path.unlink(missing_ok=True)
+                return
+            err = f"HTTP {code}"
+        except Exception as e:
+            err = str(e)
+        attempts = (entry.get("attempts") if isinstance(entry.get("attempts"), int) else 0) + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            print(f"[webpush] POST {url} fejlede {attempts} gange ({err}) – droppes", file=sys.stderr)
+            path.unlink(missing_ok=True)
+            return
+        delay = min(OUTBOX_BACKOFF_MAX, 2.0 ** attempts)
+        print(f"[webpush] POST {url} fejlede: {err} – nyt forsøg om {delay:.0f}s", file=sys.stderr)
+        entry["attempts"] = attempts
+        entry["next_try"] = time.time() + delay
+        if path.exists():
+            _atomic_write_json(path, entry)
+    finally:
+        with _OUTBOX_LOCK:
+            _OUTBOX_INFLIGHT.discard(path.name)
+
+def _outbox_drain_once() -> tuple[list, float]:
+    """Send alle forfaldne poster; returnér (futures, sek. til næste forfaldne post)."""
+    now = time.time()
+    futs, next_due = [], OUTBOX_BACKOFF_MAX
+    for p in _outbox_files():
+        with _OUTBOX_LOCK:
+            if p.name in _OUTBOX_INFLIGHT:
+                continue
+        try:
+            due = float(json.loads(p.read_text(encoding="utf-8")).get("next_try") or 0.0)
+        except Exception:
+            due = 0.0
+        if due > now:
+            next_due = min(next_due, due - now)
+            continue
+        with _OUTBOX_LOCK:
+            _OUTBOX_INFLIGHT.add(p.name)
+        futs.append(_OUTBOX_POOL.submit(_outbox_send, p))
+    return futs, next_due
+
+def _outbox_loop() -> None:
+    while True:
+        futs: list = []
+        try:
+            futs, wait_s = _outbox_drain_once()
+            for f in as_completed(futs):
+                f.result()
+        except Exception as e:
+            print(f"[outbox] Fejl: {e}", file=sys.stderr)
+            futs, wait_s = [], 5.0  # vent altid efter en fejl – ellers genindsendes samme post i ring
+        if not futs:
+            _OUTBOX_WAKE.wait(timeout=wait_s)
+            _OUTBOX_WAKE.clear()
+
+def _outbox_start() -> None:
+    """Start baggrundstråden (én pr. proces); samler også poster op fra før en genstart."""
+    global _OUTBOX_POOL, _OUTBOX_THREAD
+    with _OUTBOX_LOCK:
+        if _OUTBOX_THREAD is not None and _OUTBOX_THREAD.is_alive():
+            return
+        if _OUTBOX_POOL is None:
+            _OUTBOX_POOL = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix="outbox")
+        _OUTBOX_THREAD = threading.Thread(target=_outbox_loop, name="outbox", daemon=True)
+        _OUTBOX_THREAD.start()
+
+def outbox_flush(timeout: float = 30.0) -> int:
+    """Vent (højst 'timeout' sek.) på poster, der forfalder inden for fristen; returnér antal tilbage."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pending = False
+        for p in _outbox_files():
+            try:
+                due = float(json.loads(p.read_text(encoding="utf-8")).get("next_try") or 0.0)
+            except Exception:
+                due = 0.0
+            with _OUTBOX_LOCK:
+                inflight = p.name in _OUTBOX_INFLIGHT
+            if due <= deadline or inflight:
+                pending = True
+                break
+        if not pending:
+            break
+        _outbox_start()
+        _OUTBOX_WAKE.set()
+        time.sleep(0.05)
+    return len(_outbox_files())
+
 # ─────────────────────── Fanout (stdout/file + webpush) ───────────────────────
-def _write_digest_file(cid: str, rows_c: pd.DataFrame) -> Tuple[str, List[dict], List[str], List[str]]:
+def _write_digest_file(cid: str, recs: List[MappingProxyType]) -> Tuple[str, List[dict], List[str], List[str]]:
     """
-    Skriver batchfil (atomisk) for klientens chunk og returnerer:
+    Skriver batchfil (atomisk) for klientens chunk af records og returnerer:
       (url_path, items, regions, categories)
 
     regions/categories bruges både til at vise i UI og til server-side grovfilter.
     """
     batch_dir = BATCH_DIR
     batch_dir.mkdir(parents=True, exist_ok=True)
-    ts = dt.datetime.now(DK_TZ).strftime("%Y%m%d%H%M%S")
-    fname = f"batch-{ts}-{cid}.json"
-
-    items: List[dict] = []
-    regions_set, cats_set = set(), set()
-
-    for _, r in rows_c.iterrows():
-        cat = art_kategori(r.get("Artnavn", ""), r)  # kategori pr. item
-        afd = (r.get("DOF_afdeling", "") or "").strip()
-        if afd:
-            regions_set.add(afd)
-        if cat:
-            cats_set.add(cat)
-
-        items.append({
-            "obsid": r.get("Obsid",""),
-            "loknr": r.get("Loknr",""),          # ← NYT: send loknr med
-            "art": r.get("Artnavn",""),
-            "antal": r.get("Antal",""),
-            "adf": r.get("Adfbeskrivelse",""),
-            "lok": r.get("Loknavn",""),
-            "dof_afdeling": afd,
-            "fornavn": r.get("Fornavn",""),
-            "efternavn": r.get("Efternavn",""),
-            "lon": r.get("obs_laengdegrad") or r.get("lok_laengdegrad",""),
-            "lat": r.get("obs_breddegrad") or r.get("lok_breddegrad",""),
-            "tid_fra": r.get("Obstidfra",""),
-            "tid_til": r.get("Obstidtil",""),
-            "kategori": cat
-        })
-
-    payload = {
-        "client": cid,
-        "count": len(items),
-        "generated": dt.datetime.now(DK_TZ).isoformat(),
-        "items": items
-    }
+    generated = dt.datetime.now(DK_TZ)
+    fname = f"batch-{generated.strftime('%Y%m%d%H%M%S')}-{cid}.json"
+
+    items: List[dict] = [rec["item"] for rec in recs]
+    regions_set = {rec["afd"] for rec in recs if rec["afd"]}
+    cats_set = {rec["cat"] for rec in recs if rec["cat"]}
+
+    # Samme bytes som json.dumps(payload, indent=0): med indent=0 er et items
+    # serialisering uafhængig af indlejringsniveau, så de forud-serialiserede
+    # items kan splejses direkte ind.
+    head = json.dumps({"client": cid, "count": len(items), "generated": generated.isoformat()},
+                      ensure_ascii=False, indent=0)[:-2]
+    text = head + ',\n"items": [\n' + ",\n".join(rec["item_json"] for rec in recs) + "\n]\n}"
+    if not items:
+        text = head + ',\n"items": []\n}'
 
     # Atomisk skrivning
     out_path = (batch_dir / fname)
-    _atomic_write_text(out_path, json.dumps(payload, ensure_ascii=False, indent=0), encoding="utf-8")
+    _atomic_write_text(out_path, text, encoding="utf-8")
 
     return f"/batches/{fname}", items, sorted(regions_set), sorted(cats_set)
 
@@ -1314,150 +2852,229 @@ def purge_old_batches(max_age_hours: int = 24, verbose: bool = False) -> int:
         print(f"[Cleanup] Slettede {deleted} batch(es) ældre end {max_age_hours} timer.")
     return deleted
 
+def _normalize_timeout(val) -> Tuple[float, float]:
+    if isinstance(val, (int, float)):
+        return (3.05, float(val))
+    if isinstance(val, (list, tuple)) and len(val) == 2:
+        return (float(val[0]), float(val[1]))
+    return (3.05, 30.0)
+
+def _webpush_sink(c: dict) -> Optional[dict]:
+    wps = [s for s in c.get("sinks", [{"type": "stdout"}]) if s.get("type", "").lower() == "webpush"]
+    return wps[0] if wps else None
+
+def _digest_plan(cid: str, sink_cfg: dict, recs: list) -> List[tuple]:
+    """Skriv batchfil(er) for klientens records og returnér [(batch_url, url, payload, timeout)]."""
+    CHUNK = int(sink_cfg.get("chunk_size", 100))
+    api = sink_cfg.get("url", "http://localhost:8000/api/publish")
+    timeout = _normalize_timeout(sink_cfg.get("timeout", (3.05, 30.0)))
+    batch_api = sink_cfg.get("batch_url") or _publish_batch_url(api)
+
+    plan = []
+    for start in range(0, len(recs), CHUNK):
+        chunk = recs[start:start + CHUNK]
+
+        # Skriv batchfil og udled regions/categories for denne chunk
+        url_path, items, regions, categories = _write_digest_file(cid, chunk)
+
+        # Byg titel/teaser
+        n = len(chunk)
+        head = ", ".join(rec["head"] for rec in chunk[:3])
+        more = f" … +{n-3} flere" if n > 3 else ""
+
+        # Urgency: "high" hvis chunk har su/bemaerk, ellers "normal"
+        cats_lc = {str(x).lower() for x in categories}
+        urgency = "high" if ("su" in cats_lc or "bemaerk" in cats_lc) else "normal"
+
+        payload = {
+            "type": "digest",
+            "title": f"[{cid}] {n} nye obs",
+            "body": (head + more).strip(" ,·"),
+            "url": url_path,
+            "tag": f"bird-digest-{cid}",
+            "renotify": True,
+            # NYT: server-side filter hints
+            "regions": regions,         # fx ["DOF København", "DOF Fyn"]
+            "categories": list(cats_lc),# fx ["su","bemaerk"]
+            "urgency": urgency          # bruges af serverens header-merge
+        }
+
+        _write_latest_push({
+            "client": cid, "title": payload["title"], "body": payload["body"],
+            "url": payload["url"], "count": n, "tag": payload["tag"]
+        })
+        plan.append((batch_api, api, payload, timeout))
+    return plan
+
+def _publish_plan(plan: List[tuple]) -> None:
+    """
+    Ét /api/publish-batch-kald pr. server for hele poll'en (serveren filtrerer subs/prefs én gang);
+    endpoints uden batch-variant får enkeltkald. Afsendelse via outboxen – poll'en venter ikke.
+    """
+    batched: Dict[str, Tuple[list, Tuple[float, float]]] = {}
+    for batch_api, api, payload, timeout in plan:
+        if not batch_api:
+            outbox_put(api, payload, timeout)
+            continue
+        lst, t_old = batched.setdefault(batch_api, ([], timeout))
+        lst.append(payload)
+        batched[batch_api] = (lst, max(t_old, timeout))
+    for batch_api, (payloads, timeout) in batched.items():
+        outbox_put(batch_api, payloads, timeout)
+
+def _publish_batch_url(api: str) -> Optional[str]:
+    """'/api/publish' -> '/api/publish-batch' (None hvis endpointet ikke har en batch-variant)."""
+    base = (api or "").rstrip("/")
+    return base + "-batch" if base.endswith("/api/publish") else None
+
+# ─── Digest-vindue ───
+# Webpush-sinks kan samle digests over et tidsvindue (window_sec i clients.yaml).
+# Rækker i hastende kategorier (window_bypass, default su/bemaerk) sendes straks og
+# tager evt. ventende rækker med; øvrige samles til én batchfil/publish, når vinduet
+# lukker. Ventende rækker gemmes i state/digest_pending.json og overlever genstart.
+DIGEST_PENDING_FILE = STATE_DIR / "digest_pending.json"
+DIGEST_BYPASS_DEFAULT = ("su", "bemaerk")
+_DIGEST_PENDING: Optional[Dict[str, dict]] = None  # cid -> {"since": epoch, "recs": [record]}
+
+def _digest_pending() -> Dict[str, dict]:
+    global _DIGEST_PENDING
+    if _DIGEST_PENDING is None:
+        try:
+            raw = json.loads(DIGEST_PENDING_FILE.read_text(encoding="utf-8")) if DIGEST_PENDING_FILE.exists() else {}
+        except Exception:
+            raw = {}
+        _DIGEST_PENDING = {cid: v for cid, v in (raw or {}).items() if isinstance(v, dict) and v.get("recs")}
+    return _DIGEST_PENDING
+
+def _save_digest_pending() -> None:
+    pend = _digest_pending()
+    try:
+        if pend:
+            _atomic_write_json(DIGEST_PENDING_FILE, {cid: {"since": v["since"], "recs": [dict(r) for r in v["recs"]]}
+                                                     for cid, v in pend.items()})
+        elif DIGEST_PENDING_FILE.exists():
+            DIGEST_PENDING_FILE.unlink()
+    except Exception as e:
+        print(f"[Advarsel] Kunne ikke gemme ventende digests: {e}", file=sys.stderr)
+
+def _window_digest(cid: str, sink_cfg: dict, recs: list, now: float) -> tuple[list, bool]:
+    """Returnér (records der skal sendes nu, om ventelisten blev ændret)."""
+    window = float(sink_cfg.get("window_sec") or 0)
+    pend = _digest_pending()
+    if window <= 0 and cid not in pend:
+        return recs, False
+    bypass = {str(x).lower() for x in (sink_cfg.get("window_bypass") or DIGEST_BYPASS_DEFAULT)}
+    urgent = [r for r in recs if str(r["cat"]).lower() in bypass]
+    lower = [r for r in recs if str(r["cat"]).lower() not in bypass]
+    changed = False
+    if lower:
+        entry = pend.setdefault(cid, {"since": now, "recs": []})
+        entry["recs"].extend(lower)
+        changed = True
+    entry = pend.get(cid)
+    if entry is not None and (urgent or window <= 0 or now - float(entry["since"]) >= window):
+        pend.pop(cid, None)
+        return entry["recs"] + urgent, True
+    return urgent, changed
+
+def flush_digest_windows(clients: List[dict], now: Optional[float] = None) -> int:
+    """
+    Send digests for klienter, hvis vindue er lukket (kaldes hver poll). Returnér antal klienter.
+    Ventende rækker for klienter uden webpush-sink i 'clients' (fjernet/omdøbt) droppes.
+    """
+    pend = _digest_pending()
+    if not pend:
+        return 0
+    now = time.time() if now is None else now
+    configured = {c.get("id", "default") for c in clients if _webpush_sink(c) is not None}
+    stale = [cid for cid in pend if cid not in configured]
+    for cid in stale:
+        n = len(pend.pop(cid)["recs"])
+        print(f"[digest] {cid}: klient/webpush-sink findes ikke længere – {n} ventende rækker droppet")
+    plan: List[tuple] = []
+    flushed = 0
+    for c in clients:
+        cid = c.get("id", "default")
+        sink_cfg = _webpush_sink(c)
+        if cid not in pend or sink_cfg is None:
+            continue
+        send, _ = _window_digest(cid, sink_cfg, [], now)
+        if send:
+            plan += _digest_plan(cid, sink_cfg, send)
+            flushed += 1
+    if flushed or stale:
+        _save_digest_pending()
+    if plan:
+        _publish_plan(plan)
+    return flushed
+
 def fanout_to_clients(new_rows: pd.DataFrame, clients: List[dict], timestamp_mode: str):
     """
     Sender nye rækker til hver klient i 'clients' efter deres regler.
-    - Filtrerer rækker med build_mask(...)
+    - Router rækker til klienter (dispatch-index / kompilerede regler, se client_rows)
     - Printer kompakt linje til stdout (hvor valgt)
     - Logger til fil (append) (hvor valgt)
-    - Publicerer webpush-digests (hvor valgt)
+    - Publicerer webpush-digests samlet som ét /api/publish-batch-kald via outboxen (hvor valgt),
+      evt. samlet over sinkens tidsvindue (window_sec)
     - Skriver til web/feed.jsonl og opdaterer web/meta.json
     - Skriver seneste pushoverblik til web/latest-push.json (debug)
     """
-    import requests
-
-    def _normalize_timeout(val) -> Tuple[float, float]:
-        if isinstance(val, (int, float)):
-            return (3.05, float(val))
-        if isinstance(val, (list, tuple)) and len(val) == 2:
-            return (float(val[0]), float(val[1]))
-        return (3.05, 30.0)
-
-    for c in clients:
+    # Sikr kategori-kolonne inkl. bemaerk (kolonnevis, én gang for alle klienter)
+    rows_for_mask = new_rows if "kategori" in new_rows.columns else _ensure_kategori(new_rows)
+    # Routing: region×kategori-profiler via dispatch-index, øvrige via kompilerede regler
+    routed = client_rows(rows_for_mask, clients)
+
+    # Hver routet række renderes/serialiseres én gang; sinks vælger kun referencer
+    records = _render_records(rows_for_mask, routed, timestamp_mode)
+    if records:
+        _update_meta({rec["afd"] for rec in records.values()})
+    publish_plan: List[tuple] = []  # (batch_url, url, payload, timeout) for alle klienter
+    pending_changed = False
+    now = time.time()
+
+    for c, pos in zip(clients, routed):
         cid = c.get("id", "default")
-        rules = c.get("rules", {}) or {}
         sinks = c.get("sinks", [{"type": "stdout"}])
 
-        # Sikr kategori-kolonne inkl. bemaerk (row-wise pga. region/antal)
-        if "kategori" not in new_rows.columns:
-            tmp = new_rows.copy()
-            tmp["_antal_num"] = tmp["Antal"].apply(_parse_antal)
-            tmp["kategori"] = tmp.apply(lambda r: art_kategori(r.get("Artnavn",""), r, r.get("_antal_num")), axis=1)
-            rows_for_mask = tmp
-        else:
-            rows_for_mask = new_rows
-
-        # Filtrer rækker for denne klient
-        rows_c = rows_for_mask[build_mask(rows_for_mask, rules)]
-        if rows_c.empty:
+        # Klientens records (samme rækkefølge som rækkerne)
+        recs_c = [records[int(i)] for i in pos]
+        if not recs_c:
             continue
 
-        # FEED + META
-        _append_to_feed(cid, rows_c)
-        _update_meta(rows_c)
+        # FEED
+        _append_to_feed(cid, recs_c)
 
         # STDOUT/FILE
-        for _, r in rows_c.iterrows():
-            cat = r.get("kategori") or art_kategori(r.get("Artnavn", ""), r)
-            line = render_output_line(r, timestamp_mode, cat)
-            out = f"[{cid}] {line}"
-            for s in (s for s in sinks if s.get("type", "stdout").lower() == "stdout"):
-                print(out)
-            for s in (s for s in sinks if s.get("type", "file").lower() == "file"):
-                path = Path(s.get("path") or (OUT_DIR / f"{cid}.log"))
-                path.parent.mkdir(parents=True, exist_ok=True)
-                with path.open("a", encoding="utf-8") as f:
-                    f.write(out + "\n")
-
-        # WEBPUSH (digest pr. batch) – PARALLEL POST til server
-        wps = [s for s in sinks if s.get("type", "").lower() == "webpush"]
-        if wps:
-            sink_cfg = wps[0]
-            CHUNK = int(sink_cfg.get("chunk_size", 100))
-            api = sink_cfg.get("url", "http://localhost:8000/api/publish")
-            parallel_posts = int(sink_cfg.get("parallel_posts", 4))
-            timeout = _normalize_timeout(sink_cfg.get("timeout", (3.05, 30.0)))
-
-            tasks = []
-            for start in range(0, len(rows_c), CHUNK):
-                chunk = rows_c.iloc[start:start + CHUNK]
-
-                # Skriv batchfil og udled regions/categories for denne chunk
-                url_path, items, regions, categories = _write_digest_file(cid, chunk)
-
-                # Byg titel/teaser
-                n = len(chunk)
-                head = ", ".join(
-                    f"{r.get('Antal','')} {r.get('Artnavn','')}".strip()
-                    for _, r in chunk.head(3).iterrows()
-                )
-                more = f" … +{n-3} flere" if n > 3 else ""
-
-                # Urgency: "high" hvis chunk har su/bemaerk, ellers "normal"
-                cats_lc = {str(x).lower() for x in categories}
-                urgency = "high" if ("su" in cats_lc or "bemaerk" in cats_lc) else "normal"
-
-                payload = {
-                    "type": "digest",
-                    "title": f"[{cid}] {n} nye obs",
-                    "body": (head + more).strip(" ,·"),
-                    "url": url_path,
-                    "tag": f"bird-digest-{cid}",
-                    "renotify": True,
-                    # NYT: server-side filter hints
-                    "regions": regions,         # fx ["DOF København", "DOF Fyn"]
-                    "categories": list(cats_lc),# fx ["su","bemaerk"]
-                    "urgency": urgency          # bruges af serverens header-merge
-                }
-
-                _write_latest_push({
-                    "client": cid, "title": payload["title"], "body": payload["body"],
-                    "url": payload["url"], "count": n, "tag": payload["tag"]
-                })
-                tasks.append(payload)
-
-            def _post_one(session: requests.Session, payload: dict) -> None:
-                try:
-                    session.post(api, json=payload, timeout=timeout)
-                except Exception as e:
-                    print(f"[webpush] POST {api} fejlede: {e}", file=sys.stderr)
-
-            if tasks:
-                with requests.Session() as sess:
-                    adapter = requests.adapters.HTTPAdapter(pool_connections=parallel_posts,
-                                                            pool_maxsize=parallel_posts)
-                    sess.mount("http://", adapter); sess.mount("https://", adapter)
-                    with ThreadPoolExecutor(max_workers=parallel_posts) as pool:
-                        futs = [pool.submit(_post_one, sess, payload) for payload in tasks]
-                        for f in as_completed(futs):
-                            _ = f.result()
+        outs = [f"[{cid}] {rec['line']}" for rec in recs_c]
+        for s in (s for s in sinks if s.get("type", "stdout").lower() == "stdout"):
+            print("\n".join(outs))
+        for s in (s for s in sinks if s.get("type", "file").lower() == "file"):
+            path = Path(s.get("path") or (OUT_DIR / f"{cid}.log"))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("a", encoding="utf-8") as f:
+                f.write("".join(out + "\n" for out in outs))
+
+        # WEBPUSH (digest pr. batch) – samles på tværs af klienter og publiceres efter løkken
+        sink_cfg = _webpush_sink(c)
+        if sink_cfg is not None:
+            send, changed = _window_digest(cid, sink_cfg, recs_c, now)
+            pending_changed |= changed
+            if send:
+                publish_plan += _digest_plan(cid, sink_cfg, send)
+
+    if pending_changed:
+        _save_digest_pending()
+    _publish_plan(publish_plan)
 
 # ─────────────────────── FEED/META helpers ───────────────────────
-def _append_to_feed(cid: str, rows_c: pd.DataFrame) -> None:
+def _append_to_feed(cid: str, recs: List[MappingProxyType]) -> None:
     FEED_FILE.parent.mkdir(parents=True, exist_ok=True)
     now_iso = dt.datetime.now(DK_TZ).isoformat()
+    prefix = '{"client": ' + json.dumps(cid, ensure_ascii=False) + ', "generated": ' + json.dumps(now_iso) + ', '
     with FEED_FILE.open("a", encoding="utf-8") as f:
-        for _, r in rows_c.iterrows():
-            payload = {
-                "client": cid,
-                "generated": now_iso,
-                "obsid": r.get("Obsid",""),
-                "art": r.get("Artnavn",""),
-                "antal": r.get("Antal",""),
-                "adf": r.get("Adfbeskrivelse",""),
-                "lok": r.get("Loknavn",""),
-                "dof_afdeling": r.get("DOF_afdeling",""),
-                "fornavn": r.get("Fornavn",""),
-                "efternavn": r.get("Efternavn",""),
-                "lon": r.get("obs_laengdegrad") or r.get("lok_laengdegrad",""),
-                "lat": r.get("obs_breddegrad") or r.get("lok_breddegrad",""),
-                "tid_fra": r.get("Obstidfra",""),
-                "tid_til": r.get("Obstidtil",""),
-                "kategori": art_kategori(r.get("Artnavn",""), r),
-            }
-            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        f.write("".join(prefix + rec["feed"] + "\n" for rec in recs))
 
-def _update_meta(rows_c: pd.DataFrame) -> None:
+def _update_meta(afdelinger: Set[str]) -> None:
     META_FILE.parent.mkdir(parents=True, exist_ok=True)
     now_iso = dt.datetime.now(DK_TZ).isoformat()
     meta = {"afdelinger": [], "lastUpdated": now_iso}
@@ -1469,7 +3086,7 @@ def _update_meta(rows_c: pd.DataFrame) -> None:
         except Exception:
             meta = {"afdelinger": [], "lastUpdated": now_iso}
     existing = set(meta.get("afdelinger", []))
-    new_vals = set(v for v in rows_c.get("DOF_afdeling", pd.Series(dtype=str)).astype(str).tolist() if v)
+    new_vals = {v for v in afdelinger if v}
     meta["afdelinger"] = sorted(existing | new_vals)
     meta["lastUpdated"] = now_iso
     _atomic_write_text(META_FILE, json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -1484,67 +3101,85 @@ def _write_latest_push(payload: dict) -> None:
         print(f"[Advarsel] Kunne ikke skrive latest-push.json: {e}", file=sys.stderr)
 
 # ─────────────────────── Ændringsdetektion (loknr/dag) ───────────────────────
-def _choose_latest_row(gdf: pd.DataFrame) -> pd.Series:
-    if "Obstidfra" in gdf.columns:
-        g2 = gdf.copy()
-        g2["_t"] = g2["Obstidfra"].fillna("").astype(str)
-        g2 = g2.sort_values("_t", kind="stable")
-        r = g2.iloc[-1]
-        try:
-            r = r.drop(labels=["_t"])
-        except Exception:
-            pass
-        return r
-    return gdf.iloc[-1]
+def _latest_per_group(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Seneste række pr. group_key (sidste efter Obstidfra; ved lighed sidst i CSV'en):
+    én stabil sortering på (group_key, Obstidfra) og sidste række pr. gruppe.
+    Resultatet er ordnet efter group_key ligesom df.groupby("group_key").
+    """
+    if df.empty:
+        return df
+    keys = pd.DataFrame({"g": df["group_key"].to_numpy()}, index=df.index)
+    by = ["g"]
+    if "Obstidfra" in df.columns:
+        keys["t"] = _str_series(df, "Obstidfra").to_numpy()
+        by.append("t")
+    keys = keys.sort_values(by, kind="stable")
+    last = keys.loc[~keys["g"].duplicated(keep="last")]
+    return df.loc[last.index]
 
 def detect_and_report_changes(
     df: pd.DataFrame,
     state: Dict[str, dict],
     clients: List[dict],
     timestamp_mode: str,
+    groups: Optional[set] = None,
 ) -> Dict[str, dict]:
     """
     Finder nye førstegangs-observationer pr. (Artnavn × Loknr) pr. dag
     og registrerer desuden ANTAL-stigninger samme dag.
+    Med 'groups' (fra rækkedelta) undersøges kun de berørte grupper samt
+    grupper uden dagsaktuel state; øvrige grupper kan ikke have ændret sig.
+    Seneste række pr. gruppe joines mod state, så nye grupper og stigninger
+    er boolske masker i stedet for en Python-løkke pr. gruppe.
     """
     updated_state: Dict[str, dict] = {k: {"date": v.get("date"), "antal": v.get("antal")} for k, v in state.items()}
-    batches = []
     today_iso = dt.datetime.now(DK_TZ).date().isoformat()
 
-    # Sikr kategori-kolonne (row-wise pga. bemaerk)
-    if "kategori" not in df.columns:
-        df = df.copy()
-        df["_antal_num"] = df["Antal"].apply(_parse_antal)
-        df["kategori"] = df.apply(lambda r: art_kategori(r.get("Artnavn",""), r, r.get("_antal_num")), axis=1)
-
-    for gkey, gdf in df.groupby("group_key", dropna=False):
-        rec = updated_state.get(gkey, {"date": None, "antal": None})
-        last_date = rec.get("date")
-        last_antal = rec.get("antal")
-        r = _choose_latest_row(gdf)
-        a_new = _parse_antal(r.get("Antal", ""))
-
-        if last_date != today_iso:
-            batches.append(r)
-            updated_state[gkey] = {"date": today_iso, "antal": a_new}
-            continue
+    if groups is not None:
+        current = {k for k, v in state.items() if v.get("date") == today_iso}
+        gk = df["group_key"]
+        df = df[gk.isin(groups) | ~gk.isin(current)]
 
-        if a_new is not None and last_antal is not None and a_new > last_antal:
-            try:
-                art = (r.get("Artnavn", "") or "").strip()
-                lok = (r.get("Loknavn", "") or "").strip()
-                print(f"[Δ] {art} @ {lok}: {last_antal} → {a_new}")
-            except Exception:
-                pass
-            batches.append(r)
-            updated_state[gkey]["antal"] = a_new
-            continue
+    # Sikr kategori-kolonne (kolonnevis pga. bemaerk) og typede kolonner
+    df = _ensure_kategori(df)
+
+    latest = _latest_per_group(df)
+    if latest.empty:
+        return updated_state
+    gkeys = latest["group_key"]
+    a_new = latest["_antal_num"].astype(float)
+    prev = pd.DataFrame.from_dict(
+        {k: updated_state[k] for k in pd.unique(gkeys) if k in updated_state},
+        orient="index", columns=["date", "antal"],
+    )
+    last_date = gkeys.map(prev["date"])
+    last_antal = pd.to_numeric(gkeys.map(prev["antal"]), errors="coerce")
 
-        if last_antal is None and a_new is not None:
-            updated_state[gkey]["antal"] = a_new
+    is_new = (last_date != today_iso).to_numpy()
+    is_inc = ~is_new & (a_new > last_antal).to_numpy()  # NaN sammenligner False
+    fill = ~is_new & ~is_inc & (last_antal.isna() & a_new.notna()).to_numpy()
 
-    if batches:
-        all_new = pd.DataFrame(batches)
+    antal_vals = [None if pd.isna(v) else float(v) for v in a_new]
+    for gkey, a in zip(gkeys[is_new], np.asarray(antal_vals, dtype=object)[is_new]):
+        updated_state[gkey] = {"date": today_iso, "antal": a}
+    for gkey, a in zip(gkeys[is_inc | fill], np.asarray(antal_vals, dtype=object)[is_inc | fill]):
+        updated_state[gkey]["antal"] = a
+
+    for (_, r), a_old, a in zip(latest[is_inc].iterrows(), last_antal[is_inc], a_new[is_inc]):
+        try:
+            art = (r.get("Artnavn", "") or "").strip()
+            lok = (r.get("Loknavn", "") or "").strip()
+            print(f"[Δ] {art} @ {lok}: {a_old} → {a}")
+        except Exception:
+            pass
+
+    all_new = latest[is_new | is_inc]
+    if not all_new.empty:
+        # Samme kolonnetyper som før (rækker samlet fra Series): kategorier som object
+        cat_cols = [c for c in all_new.columns if isinstance(all_new[c].dtype, pd.CategoricalDtype)]
+        if cat_cols:
+            all_new = all_new.astype({c: object for c in cat_cols})
         sort_cols = [c for c in ["Obstidfra", "Obsid"] if c in all_new.columns]
         if sort_cols:
             all_new = all_new.sort_values(sort_cols, kind="stable")
@@ -1552,79 +3187,171 @@ def detect_and_report_changes(
 
     return updated_state
 
+# ─────────────────────── Hot-reload (clients.yaml + klassifikationsdata) ───────────────────────
+# Filerne overvåges via (mtime, størrelse); ved ændring sammenlignes indholds-hash, så
+# en ren 'touch' ikke giver genindlæsning. Nye tabeller/regler bygges færdige først og
+# udskiftes derefter samlet mellem to polls; fejler indlæsningen, beholdes de gamle.
+_RELOAD_SIGS: Dict[str, dict] = {}  # "clients"/"data" -> {"stat": ..., "sha": ...}
+
+def _classification_files() -> List[Path]:
+    return [SU_LIST, SUB_LIST] + sorted(DATA_DIR.glob("*bemaerk*.csv"))
+
+def _files_stat(paths: List[Path]) -> tuple:
+    out = []
+    for p in paths:
+        try:
+            st = p.stat()
+            out.append((str(p), st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append((str(p), None, None))
+    return tuple(out)
+
+def _files_sha(paths: List[Path]) -> str:
+    h = hashlib.sha256()
+    for p in paths:
+        h.update(str(p).encode("utf-8"))
+        try:
+            h.update(p.read_bytes())
+        except OSError:
+            h.update(b"\0missing")
+    return h.hexdigest()
+
+def _changed(name: str, paths: List[Path]) -> bool:
+    """True hvis filernes indhold er ændret siden sidst (første kald registrerer kun)."""
+    stat = _files_stat(paths)
+    prev = _RELOAD_SIGS.get(name)
+    if prev is not None and prev["stat"] == stat:
+        return False
+    sha = _files_sha(paths)
+    _RELOAD_SIGS[name] = {"stat": stat, "sha": sha}
+    return prev is not None and prev["sha"] != sha
+
+def reload_if_changed(clients: List[dict], config_path: Optional[str]) -> tuple[List[dict], bool]:
+    """
+    Genindlæs clients.yaml og/eller SU/SUB/bemaerk-data hvis de er ændret.
+    Returnerer (klienter, klassifikation_ændret).
+    """
+    global SU_SET, SUB_SET, BEMAERK_MAP
+    if config_path and _changed("clients", [Path(config_path)]):
+        t0 = time.perf_counter()
+        try:
+            new_clients = load_clients_config(config_path)
+            preds, _, generic = _dispatch_index(new_clients)
+            n_preds = len({p for ps in preds for p in ps})
+            clients = new_clients
+            print(f"[reload] {config_path}: {len(clients)} klienter, {n_preds} unikke prædikater, "
+                  f"{len(clients) - len(generic)} via dispatch-index ({(time.perf_counter() - t0) * 1000:.1f} ms)")
+        except (Exception, SystemExit) as e:
+            print(f"[Advarsel] Genindlæsning af {config_path} fejlede – beholder gamle regler: {e}", file=sys.stderr)
+        else:
+            # Ventende digests følger de nye regler: fjernede klienter droppes, window_sec=0 sendes nu
+            flushed = flush_digest_windows(clients)
+            if flushed:
+                print(f"[reload] digest: ventende rækker sendt for {flushed} klienter")
+
+    reclassified = False
+    if _changed("data", _classification_files()):
+        t0 = time.perf_counter()
+        try:
+            su, sub = load_rare_sets()
+            bem = load_bemaerk_thresholds()
+            SU_SET, SUB_SET, BEMAERK_MAP = su, sub, bem
+            _kategori_tabel()  # byg opslagstabellen nu, så omkostningen logges her
+            _FETCH_CACHE.clear()  # uændret CSV skal alligevel klassificeres igen
+            reclassified = True
+            print(f"[reload] klassifikation: SU={len(su)} SUB={len(sub)} bemaerk-regioner={len(bem)} "
+                  f"({(time.perf_counter() - t0) * 1000:.1f} ms)")
+        except Exception as e:
+            print(f"[Advarsel] Genindlæsning af SU/SUB/bemaerk fejlede – beholder gamle tabeller: {e}", file=sys.stderr)
+    return clients, reclassified
+
 # ─────────────────────── Kørsel ───────────────────────
-def run_once(date_str: str, clients: List[dict], timestamp_mode: str) -> bool:
+def run_once(date_str: str, clients: List[dict], timestamp_mode: str, send_withdraw_push: bool = True) -> bool:
     """
     Kører en enkelt iteration af scriptet.
     Returnerer True hvis kørslen var succesfuld, False hvis der var fejl ved CSV-hentning.
+    Er CSV'en uændret siden sidste gennemførte kørsel, springes parse/rollup/fanout over.
+    send_withdraw_push=False bruges efter genklassificering (tråde der skifter kategori er ikke tilbagekaldt).
     """
     ensure_dirs()
+    timings: Dict[str, float] = {}
     url = build_url(date_str)
-    csv_path = fetch_csv(url)
+    with _timed(timings, "fetch"):
+        csv_bytes, fetch_meta = fetch_csv(url)
 
-    if csv_path is None:
+    if fetch_meta.get("status") == "unchanged":
+        flush_digest_windows(clients)
+        _report_timings(timings, f"uændret ({fetch_meta.get('http')}, sha256={str(fetch_meta.get('sha256'))[:12]})")
+        return True
+    if csv_bytes is None:
         return False
 
-    try:
-        df, enc = read_csv_with_fallback(csv_path)
-    finally:
-        try:
-            csv_path.unlink()
-        except FileNotFoundError:
-            pass
-        except Exception as e:
-            print(f"[Advarsel] Kunne ikke slette downloadet CSV: {csv_path.name} ({e})", file=sys.stderr)
+    with _timed(timings, "parse"):
+        source = url.split("?", 1)[0]
+        df, enc = read_csv_with_fallback(csv_bytes, source=source)
+        del csv_bytes
+    mem_note = f"mem={_frame_mem_mb(df):.1f}MB"
 
-    # Når df er klar:
+    # Når df er klar: kategorisér én gang (genbruges af obs-lager og ændringsdetektion)
+    with _timed(timings, "kategori"):
+        df = _ensure_kategori(df)
     try:
         date_ymd = dt.datetime.strptime(date_str.strip(), "%d-%m-%Y").date().isoformat()
     except Exception:
         date_ymd = dt.datetime.now(DK_TZ).date().isoformat()
+    with _timed(timings, "delta"):
+        delta = compute_row_delta(df, date_ymd)
+    obs_failed = False
     try:
-        build_obs_storage_for_day(df, date_ymd=date_ymd, send_withdraw_push=True)
+        with _timed(timings, "obs"):
+            build_obs_storage_for_day(df, date_ymd=date_ymd, send_withdraw_push=send_withdraw_push, delta=delta)
     except Exception as e:
         print(f"[Advarsel] Bygning af obs-lager fejlede: {e}", file=sys.stderr)
+        _THREAD_REGISTRY.pop(date_ymd, None)  # næste poll bygger alle tråde igen
+        _publish_abort(OBS_BASE / date_ymd)   # halvt opbygget generation publiceres ikke
+        obs_failed = True  # hverken række-index eller validatorer gemmes: samme CSV genbehandles næste poll
 
-    state = load_state()
-
-    # Bestem dagsmappe fra CLI-datoen
-    def _date_ymd_dk(now: dt.datetime | None = None, reset_hour: int = 3) -> str:
-        now = now or dt.datetime.now(DK_TZ)
-        if now.hour < reset_hour:
-            now = now - dt.timedelta(hours=reset_hour)
-        return now.date().isoformat()
-
-    def _cli_date_to_iso(date_str: Optional[str]) -> str:
-        s = (date_str or "").strip()
-        if s:
-            try:
-                return dt.datetime.strptime(s, "%d-%m-%Y").date().isoformat()
-            except Exception:
-                pass
-        return dt.datetime.now(DK_TZ).date().isoformat()
-
-    state = load_state()
+    with _timed(timings, "state"):
+        state = load_state()
     initial = len(state) == 0
     if initial:
         today_iso = dt.datetime.now(DK_TZ).date().isoformat()
         new_state: Dict[str, dict] = {}
-        for gkey, gdf in df.groupby("group_key", dropna=False):
-            r = _choose_latest_row(gdf)
-            new_state[gkey] = {"date": today_iso, "antal": _parse_antal(r.get("Antal",""))}
-        save_state(new_state)
+        with _timed(timings, "detect"):
+            latest = _latest_per_group(df)
+            for gkey, a in zip(latest["group_key"], latest["_antal_num"]):
+                new_state[gkey] = {"date": today_iso, "antal": None if pd.isna(a) else float(a)}
+        with _timed(timings, "state"):
+            save_state(new_state)
         print(f"[Init] Lydløs baseline oprettet for {len(new_state)} grupper. (encoding={enc})")
         purge_old_batches(max_age_hours=24, verbose=False)
+        if not obs_failed:
+            commit_row_delta(delta)
+            _remember_fetch(url, fetch_meta)
+        _report_timings(timings, f"rows={len(df)} {mem_note} {_delta_summary(delta)}")
         return True
 
-    new_state = detect_and_report_changes(df, state, clients, timestamp_mode)
-    save_state(new_state)
+    with _timed(timings, "detect"):
+        groups = None if delta.get("full") else delta.get("groups")
+        new_state = detect_and_report_changes(df, state, clients, timestamp_mode, groups=groups)
+        flush_digest_windows(clients)  # digest-vinduer der er lukket uden nye rækker
+    with _timed(timings, "state"):
+        save_state(new_state)
+    if not obs_failed:
+        commit_row_delta(delta)
+        _remember_fetch(url, fetch_meta)
+    _report_timings(timings, f"rows={len(df)} {mem_note} {_delta_summary(delta)}")
     return True
 
-def run_watch(initial_date_str: str, clients: List[dict], interval_sec: int, timestamp_mode: str) -> None:
+def run_watch(initial_date_str: str, clients: List[dict], interval_sec: int, timestamp_mode: str,
+              config_path: Optional[str] = None) -> None:
     ensure_dirs()
     active_date = initial_date_str
     last_day = dt.datetime.now(DK_TZ).date()
     consecutive_failures = 0
+    _outbox_start()  # send evt. publish-kald tilbage fra før genstart
+    reload_if_changed(clients, config_path)  # registrér udgangspunkt for hot-reload
+    quiet_withdraw = False  # efter genklassificering: ingen tilbagekaldelses-push før en poll er gennemført
     print(f"Starter overvågning hver {interval_sec} sek. for dato={active_date} …")
     
     while True:
@@ -1636,9 +3363,13 @@ def run_watch(initial_date_str: str, clients: List[dict], interval_sec: int, tim
                 print(f"[Midnat] Ny dag {active_date} – state nulstillet og tidligere downloads slettet.")
                 last_day = today
             
-            success = run_once(active_date, clients, timestamp_mode=timestamp_mode)
+            clients, reclassified = reload_if_changed(clients, config_path)
+            quiet_withdraw = quiet_withdraw or reclassified
+            success = run_once(active_date, clients, timestamp_mode=timestamp_mode,
+                               send_withdraw_push=not quiet_withdraw)
             
             if success:
+                quiet_withdraw = False
                 if consecutive_failures > 0:
                     print(f"[Info] Forbindelse genoprettet efter {consecutive_failures} fejlede forsøg")
                 consecutive_failures = 0
@@ -1657,6 +3388,9 @@ def main():
     parser = argparse.ArgumentParser(
         description="Overvåg DOFbasens CSV pr. (Artnavn × Loknr) og lever klient-filtrerede output."
     )
+    parser.add_argument("command", nargs="?", choices=["run", "compile-config", "rebuild-views"], default="run",
+                        help="'run' (default), 'compile-config' (validér/kompilér --config og rapportér delte "
+                             "prædikater) eller 'rebuild-views' (genskab --date's thread.json/index.json fra dagsloggen).")
     parser.add_argument("--date", "-d", default=dt.datetime.now(DK_TZ).strftime("%d-%m-%Y"),
                         help="Dato i format DD-MM-YYYY (default: i dag i DK-tid)")
     parser.add_argument("--watch", "-w", action="store_true", help="Kør i loop og hent/scan periodisk.")
@@ -1666,6 +3400,17 @@ def main():
     parser.add_argument("--config", help="YAML med klient-profiler og regler (fx clients.yaml).")
     args = parser.parse_args()
 
+    if args.command == "compile-config":
+        if not args.config:
+            parser.error("compile-config kræver --config")
+        raise SystemExit(compile_config_report(args.config))
+    if args.command == "rebuild-views":
+        try:
+            date_ymd = dt.datetime.strptime(args.date.strip(), "%d-%m-%Y").date().isoformat()
+        except ValueError:
+            parser.error(f"Ugyldig --date: {args.date}")
+        raise SystemExit(rebuild_day_views(date_ymd))
+
     # Genindlæs bemaerk (hvis man vil regenerere filer uden at genstarte hele processen)
     global BEMAERK_MAP
     try:
@@ -1675,9 +3420,12 @@ def main():
 
     clients = load_clients_config(args.config)
     if args.watch:
-        run_watch(args.date, clients, args.interval, timestamp_mode=args.timestamp)
+        run_watch(args.date, clients, args.interval, timestamp_mode=args.timestamp, config_path=args.config)
     else:
         run_once(args.date, clients, timestamp_mode=args.timestamp)
+        left = outbox_flush(timeout=60)
+        if left:
+            print(f"[outbox] {left} publish-kald venter – sendes ved næste kørsel.", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
@@ -24,7 +24,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pywebpush import WebPushException, webpush
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, Response
 from zoneinfo import ZoneInfo
 import unicodedata
 
@@ -524,17 +524,19 @@ def _user_allows_categories_for_region(user_prefs: dict[str, dict[str, Set[str]]
     allowed_expanded = _allowed_plus(allowed)
     return bool(allowed_expanded & batch_cats)
 
-def _sub_allows_payload(sub: Dict, payload: dict, user_prefs: dict[str, dict[str, Set[str]]]) -> bool:
+def _sub_allows_payload(sub: Dict, payload: dict, user_prefs: dict[str, dict[str, Set[str]]],
+                        info: Tuple[Set[str], Set[str]] | None = None) -> bool:
     """
     Afgør om en given subscription (med evt. user_id) skal have payloaden.
     For digests (url=/batches/...) baseret på overlap (region, kategori).
+    'info' er payloadens (regions, categories), hvis den allerede er udledt.
     """
     uid = sub.get("user_id")
     # Hvis der ikke er bruger knyttet, sender vi som før
     if not uid:
         return True
 
-    regions, cats = _load_batch_info_from_payload(payload)
+    regions, cats = info if info is not None else _load_batch_info_from_payload(payload)
     # Hvis vi ikke kan udlede noget, lad den passere (fail-open)
     if not regions and not cats:
         return True
@@ -549,7 +551,6 @@ def _sub_allows_payload(sub: Dict, payload: dict, user_prefs: dict[str, dict[str
             return True
     return False
 
-
 @app.get("/sw.js")
 def serve_sw():
     path = WEB_DIR / "sw.js"
@@ -857,8 +858,9 @@ def _send_pushes_parallel(payload: dict) -> None:
     if SERVER_SIDE_FILTER:
         t0f = time.perf_counter()
         user_prefs = _load_all_user_prefs()
+        info = _load_batch_info_from_payload(payload)
         before = len(subs)
-        subs = [s for s in subs if _sub_allows_payload(s, payload, user_prefs)]
+        subs = [s for s in subs if _sub_allows_payload(s, payload, user_prefs, info)]
         durf_ms = (time.perf_counter() - t0f) * 1000
         logger.info("[PUSH/filter] subs=%d -> %d (%.1f ms) payload.url=%s",
                     before, len(subs), durf_ms, payload.get("url"))
@@ -895,14 +897,14 @@ async def publish(req: Request, background_tasks: BackgroundTasks):
             "server_side_filter": SERVER_SIDE_FILTER}
 
 # ───────────────────────────── /api/publish-batch ────────────────────────────
-def _send_batch_to_sub(sub: Dict, payloads: list, ttl: int, headers: dict) -> tuple[int, int]:
-    """Send hele batchen (sekventielt) til én subscription. Returnér (sent, errors)."""
+def _send_batch_to_sub(sub: Dict, items: list) -> tuple[int, int]:
+    """Send subscriptionens payloads (sekventielt). items: [(payload, ttl, headers)]. Returnér (sent, errors)."""
     sent = err = 0
-    for item in payloads:
+    for payload, ttl, headers in items:
         try:
             webpush(
                 subscription_info=sub,
-                data=json.dumps(item),
+                data=json.dumps(payload),
                 vapid_private_key=VAPID_PRIVATE,
                 vapid_claims=VAPID_CLAIMS,
                 ttl=ttl,
@@ -913,13 +915,19 @@ def _send_batch_to_sub(sub: Dict, payloads: list, ttl: int, headers: dict) -> tu
             status = getattr(ex, "response", None).status_code if getattr(ex, "response", None) else None
             if status in (404, 410):
                 delete_subscription(sub["endpoint"])
-            else:
-                err += 1
+                break  # subscription findes ikke længere
+            err += 1
         except Exception:
             err += 1
     return sent, err
 
 def _send_batch_parallel(payloads: list) -> None:
+    """
+    Send en samlet batch (fx alle digests fra én collector-poll).
+    Subscriptions og brugerpræferencer indlæses ÉN gang, og hver payloads
+    (regions, categories) udledes én gang; hver subscription får kun de
+    payloads, dens præferencer tillader.
+    """
     if SERVER_SIDE_FILTER:
         subs = _subs_with_user_ids()
     else:
@@ -929,33 +937,34 @@ def _send_batch_parallel(payloads: list) -> None:
         logger.info("[BATCH/bg] Ingen subscriptions (skip).")
         return
 
-    first = payloads[0] if payloads else {}
-    ttl = int((first or {}).get("ttl") or 86400)
-    headers = _merge_push_headers(first or {}, default_urgency="high")
+    prepared = [(p, int((p or {}).get("ttl") or 86400), _merge_push_headers(p or {}, default_urgency="high"))
+                for p in payloads if isinstance(p, dict)]
 
-    # Server-side filter (L1): behold kun subs der tillades af *mindst ét* payload i batchen
+    # Server-side filter (L1): pr. subscription de payloads, der matcher region/kategori
     if SERVER_SIDE_FILTER:
         t0f = time.perf_counter()
         user_prefs = _load_all_user_prefs()
+        infos = [_load_batch_info_from_payload(p) for p, _, _ in prepared]
         before = len(subs)
-        def _allows_any(sub):
-            for p in payloads:
-                if _sub_allows_payload(sub, p, user_prefs):
-                    return True
-            return False
-        subs = [s for s in subs if _allows_any(s)]
+        plan = []
+        for s in subs:
+            items = [it for it, info in zip(prepared, infos) if _sub_allows_payload(s, it[0], user_prefs, info)]
+            if items:
+                plan.append((s, items))
         durf_ms = (time.perf_counter() - t0f) * 1000
         logger.info("[BATCH/filter] subs=%d -> %d (%.1f ms) payloads=%d",
-                    before, len(subs), durf_ms, len(payloads))
+                    before, len(plan), durf_ms, len(prepared))
+    else:
+        plan = [(s, prepared) for s in subs]
 
-    if not subs:
+    if not plan:
         logger.info("[BATCH/bg] Ingen modtagere efter server-side filter.")
         return
 
     t0 = time.perf_counter()
     sent_total = err_total = 0
     with ThreadPoolExecutor(max_workers=PUSH_MAX_WORKERS) as pool:
-        futures = {pool.submit(_send_batch_to_sub, sub, payloads, ttl, headers): sub for sub in subs}
+        futures = {pool.submit(_send_batch_to_sub, sub, items): sub for sub, items in plan}
         for fut in as_completed(futures):
             try:
                 s, e = fut.result()
@@ -963,8 +972,8 @@ def _send_batch_parallel(payloads: list) -> None:
             except Exception:
                 err_total += 1
     dur_ms = (time.perf_counter() - t0) * 1000
-    logger.info("[BATCH/bg] payloads=%d subs=%d -> sent=%d errors=%d (%.1f ms) ttl=%s urgency=%s workers=%d",
-                len(payloads), len(subs), sent_total, err_total, dur_ms, ttl, headers.get("Urgency"), PUSH_MAX_WORKERS)
+    logger.info("[BATCH/bg] payloads=%d subs=%d -> sent=%d errors=%d (%.1f ms) workers=%d",
+                len(prepared), len(plan), sent_total, err_total, dur_ms, PUSH_MAX_WORKERS)
 
 @app.post("/api/publish-batch")
 async def publish_batch(req: Request, background_tasks: BackgroundTasks):
@@ -1048,22 +1057,174 @@ def _read_json_robust(path: Path, attempts: int = 5, delay: float = 0.05):
             time.sleep(delay)
     raise HTTPException(status_code=500, detail=f"Kunne ikke læse {path.name}: {last_err}")
 
+# ─────────── Forkomprimerede JSON-artefakter (collector skriver .gz/.br/.etag) ───────────
+# ETag'en læses fra <fil>.etag og caches på dens (mtime, størrelse), så en uændret fil
+# besvares med 304 uden at læse eller encode indholdet; ellers leveres de færdige bytes.
+_ARTIFACT_ETAGS: Dict[str, Tuple[Tuple[int, int], str]] = {}
+_ARTIFACT_ETAGS_MAX = 4096
+
+def _artifact_etag(path: Path) -> str | None:
+    etag_path = path.with_name(path.name + ".etag")
+    try:
+        st = etag_path.stat()
+    except FileNotFoundError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _ARTIFACT_ETAGS.get(str(path))
+    if hit and hit[0] == key:
+        return hit[1]
+    etag = etag_path.read_text(encoding="utf-8").strip()
+    if len(_ARTIFACT_ETAGS) >= _ARTIFACT_ETAGS_MAX:
+        _ARTIFACT_ETAGS.clear()
+    _ARTIFACT_ETAGS[str(path)] = (key, etag)
+    return etag
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    for tag in (if_none_match or "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag.strip('"') == etag:
+            return True
+    return False
+
+def _accepted_encodings(accept_encoding: str) -> Set[str]:
+    out: Set[str] = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for prm in params.split(";"):
+            k, _, v = prm.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            out.add(name.strip().lower())
+    return out
+
+def _json_artifact_response(request: Request, path: Path, extra_headers: dict | None = None) -> Response | None:
+    """304/200 med forkomprimerede bytes og stærk ETag; None hvis filen ikke har .etag (ældre format)."""
+    etag = _artifact_etag(path)
+    if etag is None:
+        return None
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding", **(extra_headers or {})}
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if enc in accepted:
+            try:
+                body = path.with_name(path.name + suffix).read_bytes()
+            except FileNotFoundError:
+                continue
+            return Response(content=body, media_type="application/json",
+                            headers={**headers, "Content-Encoding": enc})
+    return Response(content=path.read_bytes(), media_type="application/json", headers=headers)
+
+# ─────────── Dagsgenerationer (collector publicerer views som gen/<N>/ + current.json) ───────────
+# current.json ({"gen": N}) er den eneste fil collectoren overskriver; en generations
+# manifest.json og filerne det peger på ændres aldrig. Pointeren caches på (mtime, størrelse),
+# og et nyt generationsnummer er signalet til at slå et nyt manifest op. Uden current.json
+# læses det gamle layout direkte under web/obs/<dag>/.
+_OBS_POINTERS: Dict[str, Tuple[Tuple[int, int], int]] = {}
+_OBS_MANIFESTS: Dict[Tuple[str, int], dict] = {}
+_OBS_MANIFESTS_MAX = 64
+
+def _safe_seg(s: str) -> str:
+    return (s or "").replace("..", "").split("/")[0]
+
+def _obs_generation(date_ymd: str) -> int | None:
+    ptr = _obs_dir_for_date(date_ymd) / "current.json"
+    try:
+        st = ptr.stat()
+    except FileNotFoundError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _OBS_POINTERS.get(date_ymd)
+    if hit and hit[0] == key:
+        return hit[1]
+    try:
+        gen = int(json.loads(ptr.read_text(encoding="utf-8"))["gen"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return hit[1] if hit else None
+    _OBS_POINTERS[date_ymd] = (key, gen)
+    return gen
+
+def _obs_manifest(date_ymd: str, gen: int) -> dict | None:
+    m = _OBS_MANIFESTS.get((date_ymd, gen))
+    if m is None:
+        try:
+            m = json.loads((_obs_dir_for_date(date_ymd) / "gen" / str(gen) / "manifest.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if len(_OBS_MANIFESTS) >= _OBS_MANIFESTS_MAX:
+            _OBS_MANIFESTS.clear()
+        _OBS_MANIFESTS[(date_ymd, gen)] = m
+    return m
+
+def _obs_view(date_ymd: str, rel: str, gen: int | None = None) -> Tuple[Path | None, int | None]:
+    """(sti, generation) for et view i dagens aktuelle (eller angivne) generation; sti=None hvis ukendt."""
+    day = _obs_dir_for_date(date_ymd)
+    g = _obs_generation(date_ymd) if gen is None else gen
+    if g is None:
+        p = day / rel
+        return (p if p.exists() else None), None
+    fg = ((_obs_manifest(date_ymd, g) or {}).get("files") or {}).get(rel)
+    return (day / "gen" / str(fg) / rel if fg is not None else None), g
+
+def _gen_headers(gen: int | None) -> dict:
+    return {"X-Obs-Generation": str(gen)} if gen is not None else {}
+
 @app.get("/api/obs/summary")
-def api_obs_summary(date: str = Query("today")):
-    date_ymd = _today_ymd_dk() if (date or "").strip().lower() == "today" else (date or "").strip()
-    idx_path = _obs_dir_for_date(date_ymd) / "index.json"
-    if not idx_path.exists():
+def api_obs_summary(request: Request, date: str = Query("today"), gen: int | None = Query(None)):
+    date_ymd = _today_ymd_dk() if (date or "").strip().lower() == "today" else _safe_seg((date or "").strip())
+    idx_path, g = _obs_view(date_ymd, "index.json", gen)
+    if idx_path is None:
+        if gen is not None:
+            raise HTTPException(status_code=404, detail=f"Generation {gen} findes ikke")
         return JSONResponse(status_code=204, content=None)
-    data = _read_json_robust(idx_path)
+    try:
+        resp = _json_artifact_response(request, idx_path, _gen_headers(g))
+    except FileNotFoundError:
+        resp = None
+    if resp is not None:
+        return resp
+    if g is not None:
+        # generationens fil er væk (ryddet op) – kun det gamle layout har index.json uden .etag
+        raise HTTPException(status_code=404, detail=f"Generation {g} findes ikke længere")
+    data = _read_json_robust(idx_path)  # gammelt layout uden .etag
     if isinstance(data, dict):
         data = data.get("items", [])
     return JSONResponse(data)
 
 @app.get("/api/obs/thread/{date_ymd}/{thread_id}")
-def get_thread(date_ymd: str, thread_id: str):
-    safe_date = date_ymd.replace("..", "").split("/")[0]
-    safe_id = thread_id.replace("..", "")
-    return RedirectResponse(url=f"/obs/{safe_date}/threads/{safe_id}/thread.json")
+def get_thread(date_ymd: str, thread_id: str, gen: int | None = Query(None)):
+    url = f"/obs/{_safe_seg(date_ymd)}/threads/{_safe_seg(thread_id)}/thread.json"
+    return RedirectResponse(url=url + (f"?gen={gen}" if gen is not None else ""))
+
+@app.get("/api/obs/thread/{date_ymd}/{thread_id}/raw")
+def get_thread_raw(date_ymd: str, thread_id: str, gen: int | None = Query(None)):
+    path, _ = _obs_view(_safe_seg(date_ymd), f"threads/{_safe_seg(thread_id)}/raw.json", gen)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Rådata ikke fundet")
+    return RedirectResponse(url="/" + path.relative_to(WEB_DIR).as_posix())
+
+@app.get("/obs/{date_ymd}/threads/{thread_id}/thread.json")
+def get_thread_json(request: Request, date_ymd: str, thread_id: str, gen: int | None = Query(None)):
+    path, g = _obs_view(_safe_seg(date_ymd), f"threads/{_safe_seg(thread_id)}/thread.json", gen)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Tråd ikke fundet")
+    try:
+        resp = _json_artifact_response(request, path, _gen_headers(g))
+    except FileNotFoundError:
+        resp = None
+    if resp is not None:
+        return resp
+    if g is not None or not path.exists():
+        raise HTTPException(status_code=404, detail="Tråd ikke fundet")
+    return FileResponse(path, media_type="application/json")
 
 @app.get("/obs/{thread_id}")
 def obs_one(thread_id: str):
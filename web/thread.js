@@ -34,12 +34,15 @@
   let allowedCatsByRegion = new Map();
   let speciesOverrides = null;
   let threadEvents = [];
+  let threadRef = null;        // { date, id, gen } for den viste tråd
+  let threadRawPromise = null; // rå CSV-rækker (raw.json) hentes først når de efterspørges
 
   function parseRoute() {
     const q = new URLSearchParams(location.search);
     const date = q.get('date') || 'today';
     const id = q.get('id') || '';
-    return { date, id };
+    const gen = q.get('gen') || '';  // generation fra forsidens indeks (index og tråd fra samme udgave)
+    return { date, id, gen };
   }
   function isYMD(s) {
     return /^\d{4}-\d{2}-\d{2}$/.test(String(s || ''));
@@ -99,10 +102,12 @@
   }
   async function fetchSummary(dateParam) {
     try {
-      const r = await fetch(`./api/obs/summary?date=${encodeURIComponent(dateParam)}`, { cache: 'no-store' });
+      const r = await fetch(`./api/obs/summary?date=${encodeURIComponent(dateParam)}`, { cache: 'no-cache' });
       if (!r.ok) return [];
       const arr = await r.json();
-      return Array.isArray(arr) ? arr : [];
+      // Husk indeksets generation, så tråd og rådata hentes fra samme udgave af dagen
+      const gen = r.headers.get('X-Obs-Generation') || '';
+      return Array.isArray(arr) ? arr.map(s => (gen && s ? { ...s, _gen: gen, _genDay: dateParam } : s)) : [];
     } catch { return []; }
   }
   // --------- slut: NYT ----------
@@ -346,10 +351,47 @@
     } else {
       li.appendChild(article);
     }
+    if (ev.obsid && threadRef) appendRawToggle(li, ev);
 
     return li;
   }
 
+  // Rå DOFbasen-felter for tråden (threads/<id>/raw.json) – hentes én gang pr. tråd ved behov
+  function fetchThreadRaw() {
+    if (!threadRawPromise) {
+      const { date, id, gen } = threadRef;
+      const q = gen ? `?gen=${encodeURIComponent(gen)}` : '';
+      threadRawPromise = fetch(`./api/obs/thread/${encodeURIComponent(date)}/${encodeURIComponent(id)}/raw${q}`, { cache: 'no-cache' })
+        .then(r => (r.ok ? r.json() : {}))
+        .then(j => (j && j.rows) || {})
+        .catch(() => { threadRawPromise = null; return {}; });
+    }
+    return threadRawPromise;
+  }
+
+  function appendRawToggle(li, ev) {
+    const btn = el('button', 'badge', 'Rådata');
+    btn.type = 'button';
+    btn.style.margin = '4px 0 0';
+    btn.style.cursor = 'pointer';
+    const pre = el('pre');
+    pre.style.display = 'none';
+    pre.style.whiteSpace = 'pre-wrap';
+    pre.style.fontSize = '12px';
+    btn.addEventListener('click', async () => {
+      if (pre.style.display !== 'none') { pre.style.display = 'none'; return; }
+      if (!pre.textContent) {
+        const row = ev.raw || (await fetchThreadRaw())[String(ev.obsid)];
+        pre.textContent = row
+          ? Object.entries(row).filter(([, v]) => v !== null && v !== '').map(([k, v]) => `${k}: ${v}`).join('\n')
+          : 'Ingen rådata for denne observation.';
+      }
+      pre.style.display = '';
+    });
+    li.appendChild(btn);
+    li.appendChild(pre);
+  }
+
   // Render: thread summary item
   function renderThreadSummary(s, fallbackDay) {
     const li = document.createElement('li'); li.className = 'obs-item';
@@ -428,7 +470,8 @@
     }
 
     const d = s.day || (s.first_ts_obs || s.last_ts_obs || '').slice(0,10) || fallbackDay || todayYMDLocal();
-    const fallbackHref = `./thread.html?date=${encodeURIComponent(d)}&id=${encodeURIComponent(s.thread_id)}`;
+    const genQ = (s._gen && s._genDay === d) ? `&gen=${encodeURIComponent(s._gen)}` : '';
+    const fallbackHref = `./thread.html?date=${encodeURIComponent(d)}&id=${encodeURIComponent(s.thread_id)}${genQ}`;
     const a = document.createElement('a'); a.style.display = 'block';
 
     // Åbn altid tråden – også når der kun er 1 obs
@@ -752,17 +795,23 @@
   }
 
   // Trådvisning
-  async function loadThread(date, id) {
+  async function loadThread(date, id, gen) {
     ensureDomRefs(); // ← vigtig
     if ($frontControls) $frontControls.style.display = 'none';
     if ($st) $st.textContent = 'Henter tråd…';
 
     const tryDates = isYMD(date) ? [date] : [date, todayYMDLocal()];
-    let data = null, usedDate = date;
+    let data = null, usedDate = date, usedGen = '';
     for (const d of tryDates) {
-      const r = await fetch(`./api/obs/thread/${encodeURIComponent(d)}/${encodeURIComponent(id)}`, { cache:'no-cache' });
+      const base = `./api/obs/thread/${encodeURIComponent(d)}/${encodeURIComponent(id)}`;
+      let r = null;
+      if (gen && d === date) {
+        r = await fetch(`${base}?gen=${encodeURIComponent(gen)}`, { cache:'no-cache' });
+        if (r.status === 404) r = null;  // generationen er ryddet op – brug den aktuelle
+      }
+      if (!r) r = await fetch(base, { cache:'no-cache' });
       if (!r.ok) { usedDate = d; continue; }
-      data = await r.json(); usedDate = d; break;
+      data = await r.json(); usedDate = d; usedGen = r.headers.get('X-Obs-Generation') || ''; break;
     }
     if (!data) {
       if ($panel) $panel.style.display='none';
@@ -776,14 +825,18 @@
     const t = data.thread || {};
     const events = Array.isArray(data.events) ? data.events : [];
     threadEvents = events.slice();
+    threadRef = { date: usedDate, id: t.thread_id || id, gen: usedGen };
+    threadRawPromise = null;
 
     try {
       localStorage.setItem('last-thread-id', t.thread_id || id);
       localStorage.setItem('last-thread-date', usedDate);
     } catch {}
 
-    if (!isYMD(date) && isYMD(usedDate)) {
-      const u = new URL(location.href); u.searchParams.set('date', usedDate); history.replaceState(null,'',u.toString());
+    if ((!isYMD(date) && isYMD(usedDate)) || gen) {
+      // gen gælder kun denne visning; genindlæsning skal vise nyeste udgave
+      const u = new URL(location.href); u.searchParams.set('date', usedDate); u.searchParams.delete('gen');
+      history.replaceState(null,'',u.toString());
     }
 
     if ($title) $title.textContent = `${t.art || ''} — ${t.lok || ''}`.trim();
@@ -942,7 +995,7 @@ document.head.appendChild(style);
 // Initialize based on route
     const route = parseRoute();
     if (route.id) {
-      loadThread(route.date, route.id);
+      loadThread(route.date, route.id, route.gen);
     } else {
       suggestThreads(route.date === 'today' ? undefined : route.date);
     }